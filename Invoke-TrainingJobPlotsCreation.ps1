@@ -27,4 +27,5 @@ if (-not (Test-Path "$jobDownloadLocation\*" -Include *.csv)) {
 # Next, run the python stuff. This might take a while.
 Write-Progress -Activity "Creating Training Plots" -Status "Generating Plots"
 $resultsLocation = "$locationPath\results"
-python .\notebooks\training_job_dumper.py "$jobDownloadLocation" "$resultsLocation" $jobID
+# The job number is taken from the name of the job directory. Plots that are already up to date are not re-made.
+python .\notebooks\training_job_dumper.py --batch "$resultsLocation" "$jobDownloadLocation"
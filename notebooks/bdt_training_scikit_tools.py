@@ -1,22 +1,101 @@
 # Tools to help with using our data and scikit-learn
 # To be imported by other notebooks, etc.
+# matplotlib and sklearn are only imported by the functions that use them, so that
+# processes that just load samples or run trainings (e.g. pool workers) start quickly.
 
 from glob import glob
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
-from math import sqrt
+from sample_cache import load_cached_sample
+from model_registry import training_data_fingerprint, model_key
+from instrumentation import peak_memory_usage, timed, stage, count_first_rows
 
-from sklearn.ensemble import AdaBoostClassifier, GradientBoostingClassifier
-from sklearn.metrics import accuracy_score
-from sklearn.tree import DecisionTreeClassifier
+def read_sample_files(files, columns = None, predicate = None, predicate_columns = (), chunksize = 1000000):
+    '''Read a list of csv or pickle files into a single DataFrame.
 
-def load_sample(name_pattern_root):
+    Args
+        files - list of csv or pickle files
+        columns - list of columns to keep. None means all of them.
+        predicate - function that takes a DataFrame and returns a mask of the rows to keep. csv files
+                    are read chunksize rows at a time and each chunk is cut down as it is read.
+        predicate_columns - the columns the predicate needs that aren't in columns (they are read too)
+
+    Returns
+        df - Dataframe of all files contacted together
+    '''
+    if predicate is None:
+        dfs = [pd.read_pickle(f) for f in files if f.endswith(".p")] + [pd.read_csv(f, usecols=columns) for f in files if f.endswith(".csv")]
+    else:
+        usecols = None if columns is None else list(columns) + [c for c in predicate_columns if c not in columns]
+        dfs = [adf[predicate(adf)] for adf in [pd.read_pickle(f) for f in files if f.endswith(".p")]]
+        for f in [f for f in files if f.endswith(".csv")]:
+            dfs += [chunk[predicate(chunk)] for chunk in pd.read_csv(f, usecols=usecols, chunksize=chunksize)]
+    if columns is not None:
+        dfs = [adf.loc[:,columns] for adf in dfs]
+    return dfs[0] if len(dfs) == 1 else pd.concat(dfs)
+
+# Columns that are summed over a lot - keep them at full precision.
+full_precision_columns = ['Weight', 'WeightMCEvent', 'WeightXSection']
+
+# Columns that are cut on (see trim_mask) - float32 would move events across the cut boundaries.
+cut_columns = ['JetEta', 'mc_Lxy', 'mc_Lz']
+
+# The sample cache variant of a downcast sample. Changes whenever downcast_sample does, so old caches get rebuilt.
+downcast_variant = 'downcast-2'
+
+def downcast_sample(df, keep = full_precision_columns + cut_columns):
+    '''Shrink a sample in memory. float64 columns become float32, and the EventNumber
+    and Class columns become the smallest integer type that holds them.
+
+    This is not free: sklearn's exact trees work in float32 internally and see the same
+    values, but HistGradientBoosting finds its bin edges from the values it is given, so a
+    float32 sample can train to a slightly different BDT. The weights and the columns that
+    are cut on are left alone.
+
+    Args
+        df - the DataFrame to downcast
+        keep - columns that should not be touched
+
+    Returns
+        df - a new DataFrame with the downcast columns
+    '''
+    data = {}
+    for c in df.columns:
+        col = df[c]
+        if c in keep:
+            data[c] = col
+        elif c in ('EventNumber', 'Class'):
+            data[c] = pd.to_numeric(col, downcast='unsigned' if col.min() >= 0 else 'integer')
+        elif col.dtype == np.float64:
+            data[c] = col.astype(np.float32)
+        else:
+            data[c] = col
+    return pd.DataFrame(data, columns=df.columns, index=df.index)
+
+def print_memory_report(samples, indent = '  '):
+    '''Print the memory used by a list of samples, along with the peak memory of the process'''
+    used = sum(s.memory_usage(index=True).sum() for s in samples)
+    peak = peak_memory_usage()
+    print ("{0}Memory: {1:.1f} MB in samples, peak process memory {2}".format(indent, used/1024.0/1024.0,
+        "unknown" if peak is None else "{0:.1f} MB".format(peak/1024.0/1024.0)))
+
+@timed('load_sample')
+def load_sample(name_pattern_root, columns = None, use_cache = False, cache_root = None, downcast = False,
+                predicate = None, predicate_columns = ()):
     '''Load in all files with prefex name.
     
     Args:
         name_pattern_root - path pattern that resovles to a set of csv or pickle files.
+        columns - list of columns to load. None means all of them.
+        use_cache - if True, the files are converted once to a columnar cache (see sample_cache)
+                    and read back memory-mapped. The cache is rebuilt if any source file changes.
+        cache_root - where to keep the cache. Defaults to .sample_cache next to the files.
+        downcast - if True, shrink the column types (see downcast_sample)
+        predicate - function that takes a DataFrame and returns a mask of the rows to keep. It is
+                    applied while the sample is read, so only the rows that pass are ever in memory
+                    (e.g. trim_predicate()).
+        predicate_columns - the columns the predicate looks at that aren't in columns
         
     Returns
         df - Dataframe of all files contacted together
@@ -25,114 +104,206 @@ def load_sample(name_pattern_root):
     if len(files) == 0:
         print ("No files found matching {0}".format(name_pattern_root))
         return
-    
-    dfs = [pd.read_pickle(f) for f in files if f.endswith(".p")] + [pd.read_csv(f) for f in files if f.endswith(".csv")]
-    df = dfs[0]
-    for adf in dfs[1:]:
-        df = df.append(adf)
-    return df
 
-def load_default_samples(job, indent='  '):
+    reader = (lambda: downcast_sample(read_sample_files(files))) if downcast else (lambda: read_sample_files(files))
+    if use_cache:
+        return load_cached_sample(name_pattern_root, files, reader, columns = columns, cache_root = cache_root,
+                                  variant = downcast_variant if downcast else None,
+                                  predicate = predicate, predicate_columns = predicate_columns)
+    df = read_sample_files(files, columns, predicate, predicate_columns)
+    return downcast_sample(df) if downcast else df
+
+def load_default_samples(job, indent='  ', columns = None, use_cache = False, downcast = False, signal_predicate = None):
     '''Return the bib, mj, and signal samples for this job from the
     default location.
     
     Args
         job - name of job subdirectory
+        columns - list of columns to load. None means all of them.
+        use_cache - load through the columnar sample cache (fast after the first time). The
+                    cache is written to a .sample_cache directory next to the samples.
+        downcast - store features as float32 and EventNumber as a compact integer (see downcast_sample)
+        signal_predicate - (predicate, predicate columns) to cut the signal sample down as it is loaded
+                           (see load_sample)
         
     Returns
         bib - the bib dataframe
         multijet - the mj dataframe
         signal - the signal dataframe
     '''
-    bib = load_sample("../../MVARawData/{0}/bib16".format(job))
-    multijet = load_sample("../../MVARawData/{0}/multijet".format(job))
-    signal = load_sample("../../MVARawData/{0}/signal".format(job))
+    bib = load_sample("../../MVARawData/{0}/bib16".format(job), columns, use_cache, downcast = downcast)
+    multijet = load_sample("../../MVARawData/{0}/multijet".format(job), columns, use_cache, downcast = downcast)
+    predicate, predicate_columns = signal_predicate if signal_predicate is not None else (None, None)
+    signal = load_sample("../../MVARawData/{0}/signal".format(job), columns, use_cache, downcast = downcast,
+                         predicate = predicate, predicate_columns = predicate_columns)
     
     print ("{1}BIB: {0} events".format(len(bib.index), indent))
     print ("{1}Multijet: {0} events".format(len(multijet.index), indent))
     print ("{1}Signal: {0} events".format(len(signal.index), indent))
+    print_memory_report((bib, multijet, signal), indent)
 
     return (bib, multijet, signal)
 
 default_cut_Lxy = 1250
 default_cut_Lz = 3500
 eta_seperator_cut = 1.4
+trim_columns = ['JetEta', 'mc_Lxy', 'mc_Lz']
+def trim_mask(sample, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+    '''Return the mask of the events that pass the lxy and lz cuts'''
+    return ((abs(sample.JetEta) > eta_seperator_cut) & (sample.mc_Lz*1000 > cut_Lz)) | ((abs(sample.JetEta) <= eta_seperator_cut) & (sample.mc_Lxy*1000 > cut_Lxy))
+
 def trim_sample(sample, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
     '''Trim lxy and lz cuts for a sample'''
-    return sample[((abs(sample.JetEta) > eta_seperator_cut) & (sample.mc_Lz*1000 > cut_Lz)) | ((abs(sample.JetEta) <= eta_seperator_cut) & (sample.mc_Lxy*1000 > cut_Lxy))]
+    return sample[trim_mask(sample, cut_Lxy, cut_Lz)]
+
+def trim_predicate(cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+    '''Return the lxy and lz cuts as a (predicate, predicate columns) pair for load_sample'''
+    return (lambda sample: trim_mask(sample, cut_Lxy, cut_Lz), trim_columns)
 
 def trim_samples(all_events):
     '''Trim default lxy and lz cuts for a tuple of (mj, bib, signal) samples'''
     return (all_events[0], all_events[1], trim_sample(all_events[2]))
 
 def load_trimmed_sample(jobNo):
-    '''Load and trim a sample from a job, and record it in our sample archive'''
+    '''Load and trim a sample from a job, and record it in our sample archive.
+    The signal is trimmed as it is read, so the untrimmed signal is never in memory.'''
     print ('Job {0}:'.format(jobNo))
-    all_events_all = load_default_samples(jobNo)
-    all_events = trim_samples(all_events_all)
+    all_events = load_default_samples(jobNo, signal_predicate = trim_predicate())
     print (" ", [len(e.index) for e in all_events])
     
     return all_events
 
-def fraction (fractionGoal):
-    '''Return a function that will take from a randomly distributed number a fraction of events.
-    Meant to be used against an EventNumber to evenly pair down the number of events.
-    
+class TrimScan:
+    '''Apply many different lxy and lz cuts to the same sample.
+
+    The decay lengths are sorted once (lz for the events with |eta| above eta_seperator_cut, lxy for
+    the rest), so the events passing any pair of cuts are found with two binary searches, and the
+    count and sum of weights of the events passing come from running sums without looking at the events.
+    '''
+    def __init__(self, sample, weight = 'Weight'):
+        self.sample = sample
+        forward = np.abs(sample.JetEta.values) > eta_seperator_cut
+        self.regions = []
+        for in_region, length in ((~forward, sample.mc_Lxy.values), (forward, sample.mc_Lz.values)):
+            length = length*1000
+            rows = np.flatnonzero(in_region & ~np.isnan(length))
+            order = np.argsort(length[rows], kind='mergesort')
+            rows = rows[order]
+            w = sample[weight].values[rows] if weight is not None else np.ones(len(rows))
+            # Sum of the weights of this event and all the longer ones
+            above = np.r_[np.cumsum(w[::-1])[::-1], 0.0]
+            self.regions.append((length[rows], rows, above))
+
+    def _first_passing(self, cut_Lxy, cut_Lz):
+        return [np.searchsorted(lengths, cut, side='right') for (lengths, rows, above), cut in zip(self.regions, (cut_Lxy, cut_Lz))]
+
+    def rows(self, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+        '''Return the (sorted) positions of the events that pass the cuts'''
+        return np.sort(np.concatenate([r[1][first:] for r, first in zip(self.regions, self._first_passing(cut_Lxy, cut_Lz))]))
+
+    def trim(self, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+        '''Return the events that pass the cuts, same as trim_sample'''
+        return self.sample.iloc[self.rows(cut_Lxy, cut_Lz)]
+
+    def count(self, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+        '''Return the number of events that pass the cuts'''
+        return sum(len(r[1]) - first for r, first in zip(self.regions, self._first_passing(cut_Lxy, cut_Lz)))
+
+    def sum_weights(self, cut_Lxy = default_cut_Lxy, cut_Lz = default_cut_Lz):
+        '''Return the sum of the weights of the events that pass the cuts'''
+        return sum(r[2][first] for r, first in zip(self.regions, self._first_passing(cut_Lxy, cut_Lz)))
+
+def event_number_hash(event_number):
+    '''Scramble event numbers so they are spread evenly over the full 64 bit range. The same
+    event number always gives the same value, so this can be used to pick events reproducibly.
+    Uses Fibonacci hashing (multiply by 2^64/golden ratio), which mixes even sequential numbers well.
+
     Args
-        fractionGoal - the fraction of events we'd like to see
-        
+        event_number - array of event numbers
+
     Returns
-        func - A function that will return True or False when given an event number. True, then keep the event.
+        h - array of uint64 values
     '''
-    if (fractionGoal < 0) | (fractionGoal > 1.0):
-        raise Exception("Fraction must be between 0.0 and 1.0 (not {0})".format(fractionGoal))
-        
-    seq = ()
-    fg = fractionGoal
-    maxCount = 300
-    for i in range(1, maxCount):
-        frac = 1.0/i
-        if frac <= fg:
-            seq = seq + (i,)
-            remainingSequence = [i for i in range(maxCount) if len([j for j in seq if i%j == 0]) != 0]
-            actualFraction = len(remainingSequence)/maxCount
-            fg = fractionGoal - actualFraction
-
-    return seq
-    #return lambda x: len([i for i in seq if x%i == 0]) != 0
-    #return lambda x: x%i == 0
-    
-def calcDFFilter (df, seq):
-    '''Filter used to split off fraction of events in the get_fraction_of_events method'''
-    gf, *gfRest = [df.EventNumber%i==0 for i in seq]
-    for g in gfRest:
-        gf = gf | g
-    return gf
-
-def get_fraction_of_events(events, fractionToUse):
-    '''Return a fraction of all events as training and testing samples.
-    
+    return np.asarray(event_number).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+def fraction_threshold(event_numbers, fractionToUse, exact = True):
+    '''Return the event number hash (see event_number_hash) below which events are kept, for a fraction
+    of less than 1. The same threshold is used for every sample, so an event number is either kept
+    everywhere or nowhere.
+
     Args
-        fractionToUse - If less than 1 then the fraction of each sample to use.
-                        If > 1, then the total number of events
-        
+        event_numbers - list of arrays of event numbers, one for each sample
+        fractionToUse - the fraction of events to keep (0 to 1)
+        exact - If True the threshold keeps exactly round(fraction*N) of the N distinct event numbers in all the
+                samples together (the ones with the smallest hash, so a smaller fraction is always a subset of a
+                larger one). Each sample on its own gets the fraction up to statistical fluctuations. If False
+                an event is kept if its hash is below the fraction of the full range, which doesn't need to look
+                at the samples at all, but only gets the fraction on average.
+
     Returns
-        training - Training tripple of events (bib, mj, sig)
-        testing - Testing tripple of events (bib, mj, sig)
-    
+        threshold - uint64 hash value, or None if every event is kept
     '''
-    # Parse out the first parameter.
-    fracsUC = (fractionToUse, fractionToUse, fractionToUse) if fractionToUse <= 1.0 else \
-                (fractionToUse/len(e.index) for e in events)
-    fracs = (f if f <= 1.0 else 1.0 for f in fracsUC)
-    
-    # Create the per event filter. We have to do this against each
-    # of the three input samples.
-    seqs = (fraction(f) for f in fracs)
-    fracFilters = [calcDFFilter(df, seq) for df, seq in zip(events, seqs)]
+    if (fractionToUse < 0) or (fractionToUse > 1.0):
+        raise Exception("Fraction must be between 0.0 and 1.0 (not {0})".format(fractionToUse))
+    if not exact:
+        return np.uint64(min(fractionToUse*2.0**64, 2.0**64-2048)) if fractionToUse < 1.0 else None
+
+    # The hash is a bijection, so distinct event numbers have distinct hashes. (A sort is much
+    # quicker than np.unique here.)
+    h = np.sort(np.concatenate([event_number_hash(e) for e in event_numbers]))
+    h = h[np.r_[True, h[1:] != h[:-1]][:len(h)]]
+    n_keep = int(round(fractionToUse*len(h)))
+    return h[n_keep] if n_keep < len(h) else None
+
+def count_mask(event_number, count):
+    '''Return a mask that keeps exactly count events (all of them if there are fewer): the ones with
+    the smallest event number hash, so a smaller count is always a subset of a larger one.'''
+    mask = np.zeros(len(event_number), dtype=bool)
+    if count >= len(mask):
+        mask[:] = True
+    elif count > 0:
+        mask[np.argpartition(event_number_hash(event_number), count-1)[:count]] = True
+    return mask
+
+def fraction_masks(event_numbers, fractionToUse, exact = True):
+    '''Return a mask for each sample that keeps a fraction of its events, picked by their event number.
 
-    fraction_events = [dfi[1][dfi[0]] for dfi in zip(fracFilters,events)]
-    return fraction_events
+    Args
+        event_numbers - list of arrays of event numbers, one for each sample
+        fractionToUse - If less than 1 then the fraction of events to keep (see fraction_threshold for exact).
+                        If > 1, then the number of events to keep from each sample (see count_mask).
+
+    Returns
+        masks - list of boolean arrays, True for the events to keep
+    '''
+    if fractionToUse > 1.0:
+        return [count_mask(e, int(fractionToUse)) for e in event_numbers]
+    threshold = fraction_threshold(event_numbers, fractionToUse, exact)
+    if threshold is None:
+        return [np.ones(len(e), dtype=bool) for e in event_numbers]
+    return [event_number_hash(e) < threshold for e in event_numbers]
+
+def fraction_mask(event_number, fractionToUse, exact = True):
+    '''Return a mask that keeps a fraction of events, picked by their event number (see fraction_masks).
+    With exact, the fraction is of just these events - use fraction_masks to pick from several samples at once.'''
+    return fraction_masks([event_number], fractionToUse, exact)[0]
+
+@timed('get_fraction_of_events')
+def get_fraction_of_events(events, fractionToUse, exact = True):
+    '''Return a fraction of the events of each sample.
+
+    Args
+        events - tripple of events (bib, mj, sig)
+        fractionToUse - If less than 1 then the fraction of the events to use: exactly that fraction of the
+                        event numbers of all the samples together (see fraction_threshold).
+                        If > 1, then the number of events to use from each sample.
+        exact - if False, pick events with a fixed hash cut, which only gets the fraction on average
+
+    Returns
+        events - tripple of the events that were kept (bib, mj, sig)
+    '''
+    masks = fraction_masks([df.EventNumber.values for df in events], fractionToUse, exact)
+    return [df[m] for df, m in zip(events, masks)]
 
 # The default variable list for training
 default_training_variable_list = ['JetPt', 'CalRatio',
@@ -157,7 +328,21 @@ default_training_variable_list = ['EnergyDensity',
  'PredictedLz',
  'SumPtOfAllTracks']
 
+def concat_columns(samples, columns):
+    '''Stack a list of DataFrames, keeping only some columns. Unlike DataFrame.append this
+    does a single allocation per column, no matter how many samples there are.
+
+    Args
+        samples - list of DataFrames to stack
+        columns - the columns to keep
+
+    Returns
+        df - DataFrame with the columns, and a fresh index
+    '''
+    return pd.DataFrame({c: np.concatenate([s[c].values for s in samples]) for c in columns}, columns=list(columns))
+
 # Prep the samples for training - limit number of events, etc.
+@timed('prep_samples', rows=count_first_rows)
 def prep_samples (bib, mj, sig, nEvents = 0, training_variable_list = default_training_variable_list):
     '''Convert the input data frames into samples that are ready to feed to the
     scikitlearn infrastructure.
@@ -176,22 +361,75 @@ def prep_samples (bib, mj, sig, nEvents = 0, training_variable_list = default_tr
     '''
     # Append the three inputs, as they are what we will be fitting against.
     # At the same time (to keep things straight) build the class sigle array.
-    s_bib = bib if nEvents == 0 else bib[:nEvents]
-    s_bib_class = pd.DataFrame(np.zeros(len(s_bib.index)), columns=['Class'], dtype = 'int64')
-    s_mj = mj if nEvents == 0 else mj[:nEvents]
-    s_mj_class = pd.DataFrame(np.ones(len(s_mj.index)), columns=['Class'], dtype = 'int64')
-    s_sig = sig if nEvents == 0 else sig[:nEvents]
-    s_sig_class = pd.DataFrame(np.ones(len(s_sig.index))*2, columns=['Class'], dtype = 'int64')
-    
-    all_events = s_bib.append(s_mj, ignore_index=True)
-    all_events = all_events.append(s_sig, ignore_index=True)
-    
-    all_events_class = s_bib_class.append(s_mj_class, ignore_index=True)
-    all_events_class = all_events_class.append(s_sig_class, ignore_index=True)
+    # Only the columns we need are copied, each with a single allocation.
+    samples = [s if nEvents == 0 else s[:nEvents] for s in (bib, mj, sig)]
+    all_events = concat_columns(samples, training_variable_list)
+    weights = concat_columns(samples, full_precision_columns)
+    all_events_class = pd.DataFrame(np.repeat(np.arange(3, dtype='int8'), [len(s.index) for s in samples]), columns=['Class'])
+
+    return (all_events, all_events_class, weights.Weight, weights.WeightMCEvent*weights.WeightXSection)
+
+def gradient_boosting_classifier(**kwargs):
+    '''Create a GradientBoostingClassifier'''
+    from sklearn.ensemble import GradientBoostingClassifier
+    return GradientBoostingClassifier(**kwargs)
+
+def hist_gradient_boosting_classifier(**kwargs):
+    '''Create a HistGradientBoostingClassifier. Older versions of sklearn
+    only have it as an experimental feature that has to be switched on.'''
+    try:
+        from sklearn.ensemble import HistGradientBoostingClassifier
+    except ImportError:
+        from sklearn.experimental import enable_hist_gradient_boosting
+        from sklearn.ensemble import HistGradientBoostingClassifier
+    return HistGradientBoostingClassifier(**kwargs)
+
+# The training backends we know how to run.
+#   exact - sklearn's GradientBoostingClassifier. Single threaded, exact splits.
+#   hist - sklearn's HistGradientBoostingClassifier. Multithreaded, splits on 255 binned values.
+#          Same depth and learning rate, and early stopping is off so it runs the same number of boosts.
+training_backends = {
+    'exact': lambda estimators: gradient_boosting_classifier(max_depth=3, n_estimators=estimators),
+    'hist': lambda estimators: hist_gradient_boosting_classifier(max_depth=3, max_iter=estimators, early_stopping=False),
+}
+default_training_backend = 'exact'
+
+# Set to a model_registry.ModelRegistry to remember trained models between runs.
+# default_training and train_me will then re-use a model if the same training was run before.
+model_registry = None
+
+def fit_or_load(bdt, events, events_weight, events_class, registry = None, fraction = None, event_mod = None):
+    '''Fit the bdt, or, if the registry has a model from the same training, return that instead.
+
+    Args
+        bdt - the (un-fit) classifier
+        events, events_weight, events_class - the training inputs, as for default_training
+        registry - the ModelRegistry to use. None means model_registry (and if that is None too
+                   the bdt is just fit).
+        fraction, event_mod - how the training sample was picked, to tell trainings apart
+                   (see model_key)
 
-    return (all_events.loc[:,training_variable_list], all_events_class, all_events.Weight, all_events.WeightMCEvent*all_events.WeightXSection)
+    Returns
+        bdt - the trained classifier
+    '''
+    registry = model_registry if registry is None else registry
+    if registry is None:
+        with stage('fit', rows=len(events.index)):
+            return bdt.fit(events, events_class.Class, sample_weight = events_weight)
+
+    params = bdt.get_params()
+    key = model_key(list(events.columns), params, training_data_fingerprint(events, events_weight, events_class.Class.values), fraction, event_mod)
+    stored = registry.get(key)
+    if stored is not None:
+        return stored
+
+    with stage('fit', rows=len(events.index)):
+        bdt.fit(events, events_class.Class, sample_weight = events_weight)
+    registry.put(key, bdt, {'Estimator': type(bdt).__name__, 'Params': params, 'Variables': list(events.columns),
+                            'Events': len(events.index), 'Fraction': fraction, 'EventMod': event_mod})
+    return bdt
 
-def default_training (events, events_weight, events_class, estimators = 1000):
+def default_training (events, events_weight, events_class, estimators = 1000, backend = None, registry = None, fraction = None, event_mod = None):
     '''Given samples prepared, run the default "best" training we know how to run.
     
     Args:
@@ -199,25 +437,31 @@ def default_training (events, events_weight, events_class, estimators = 1000):
         events_weight - weight assigned to each event (None if no weight is to be used)
         events_class - the training class (0, 1, 2 for bib, mj, and signal)
         estimators - The number of boosts to run
+        backend - Which boosting implementation to use (see training_backends). None
+                  means default_training_backend.
+        registry, fraction, event_mod - where to look for an already trained model (see fit_or_load)
         
     Returns
         bdt - A trained boosted decision tree
     '''
     
-    bdt = GradientBoostingClassifier(max_depth=3, n_estimators=estimators)
+    backend = default_training_backend if backend is None else backend
+    if backend not in training_backends:
+        raise Exception("Unknown training backend '{0}' (known: {1})".format(backend, list(training_backends.keys())))
+    bdt = training_backends[backend](estimators)
     
     #bdt = AdaBoostClassifier(
     #    DecisionTreeClassifier(min_samples_leaf=min_leaf_fraction),
     #    n_estimators=10,
     #    learning_rate=1)
     
-    bdt.fit(events, events_class.Class, sample_weight = events_weight)
+    bdt = fit_or_load(bdt, events, events_weight, events_class, registry, fraction, event_mod)
     
     # The BDT is sent back for use
     return bdt
     
 
-def train_me (bib, mj, sig, nEvents = 10000, training_variable_list = default_training_variable_list):
+def train_me (bib, mj, sig, nEvents = 10000, training_variable_list = default_training_variable_list, backend = 'adaboost', registry = None):
     '''Return training on nEvents
     
     Classes are 0 for bib, 1 for mj, and 2 for sig
@@ -229,17 +473,24 @@ def train_me (bib, mj, sig, nEvents = 10000, training_variable_list = default_tr
         mj - MJ background (with weights)
         sig - signal (with weights)
         nEvents - how many events of each to use
+        backend - 'adaboost' for the quick 10 boost AdaBoost, or one of the training_backends
+                  to run the default_training with that backend.
+        registry - where to look for an already trained model (see fit_or_load)
     '''
     
     all_events, all_events_class, training_weight, evaluation_weight = prep_samples(bib, mj, sig, nEvents, training_variable_list)
+    if backend != 'adaboost':
+        return default_training(all_events, training_weight, all_events_class, backend = backend, registry = registry)
     
     # Ready to train!
+    from sklearn.ensemble import AdaBoostClassifier
+    from sklearn.tree import DecisionTreeClassifier
     bdt_discrete = AdaBoostClassifier(
         DecisionTreeClassifier(min_samples_leaf=0.01),
         n_estimators=10,
         learning_rate=1)
     
-    bdt_discrete.fit(all_events, all_events_class.Class, sample_weight = training_weight)
+    bdt_discrete = fit_or_load(bdt_discrete, all_events, training_weight, all_events_class, registry)
     
     # The BDT is sent back for use
     return bdt_discrete
@@ -262,7 +513,109 @@ def test_train_samples(sample_list, event_mod = 3):
     
     return (training, testing)
 
-def plot_training_performance (bdt, training_sample, testing_sample, title_keyword):
+def weighted_confusion_matrix(classes, predictions, weights = None, nclasses = 3):
+    '''Return the (weighted) number of events of each actual class predicted as each class.
+
+    Args
+        classes - array of the actual class of each event
+        predictions - array of the predicted class of each event
+        weights - array of event weights (None to just count events)
+        nclasses - the number of classes
+
+    Returns
+        m - nclasses x nclasses array, m[actual, predicted]
+    '''
+    index = np.asarray(classes, dtype=np.intp)*nclasses + np.asarray(predictions, dtype=np.intp)
+    return np.bincount(index, weights=weights, minlength=nclasses*nclasses).reshape(nclasses, nclasses)
+
+def _staged_classes(bdt, events, every):
+    '''Yield (stage, predicted class) for every k-th stage of the bdt, and the last one'''
+    last = None
+    for index, dec in enumerate(bdt.staged_decision_function(events)):
+        i_stage = index + 1
+        last = (i_stage, dec)
+        if i_stage % every == 0:
+            yield (i_stage, bdt.classes_[np.argmax(dec, axis=1)])
+            last = None
+    if last is not None:
+        yield (last[0], bdt.classes_[np.argmax(last[1], axis=1)])
+
+def training_curves(bdt, training_sample, testing_sample, every = 1, training_variables = default_training_variable_list):
+    '''Calculate how the training performs as a function of the number of trees.
+
+    The staged decision function is walked once for each sample, and each stage is
+    summarized with a single weighted confusion matrix.
+
+    Args
+        bdt - the BDT we are testing
+        training_sample - the tripple of training samples (bib, mj, hss) as treturned from test_train_samples
+        testing_sample - the tripple of testing samples
+        every - only evaluate every k-th stage (the last stage is always evaluated)
+        training_variables - the variables the BDT was trained on
+
+    Returns
+        curves - dict of arrays, one entry per evaluated stage:
+                    Stages - number of trees
+                    TestError, TrainError - fraction of events with the wrong predicted class
+                    HSSSsqrtB - S/sqrt(B) on the testing sample (mc weights)
+                    BIBEff, MJEff, HSSEff - per-class efficiency on the testing sample (mc weights)
+                 And for the final stage:
+                    TestClass, TestPredictions, TrainClass, TrainPredictions - actual and predicted classes
+    '''
+    test_events, test_events_class, test_weights, test_eval_weights = prep_samples(testing_sample[0], testing_sample[1], testing_sample[2], training_variable_list=training_variables)
+    train_events, train_events_class, training_weights, training_eval_weights = prep_samples(training_sample[0], training_sample[1], training_sample[2], training_variable_list=training_variables)
+    test_class = test_events_class.Class.values
+    train_class = train_events_class.Class.values
+    test_eval_weights = test_eval_weights.values
+
+    stages = []
+    test_error = []
+    ssqrtb = []
+    eff = []
+    for i_stage, pred in _staged_classes(bdt, test_events, every):
+        counts = weighted_confusion_matrix(test_class, pred)
+        weighted = weighted_confusion_matrix(test_class, pred, test_eval_weights)
+        stages.append(i_stage)
+        test_error.append(1.0 - np.trace(counts)/len(pred))
+        eff.append(np.diag(weighted)/np.sum(weighted, axis=1))
+        ssqrtb.append(weighted[2,2]/np.sqrt(np.sum(weighted[:2,2])))
+        test_predictions = pred
+
+    train_error = []
+    for i_stage, pred in _staged_classes(bdt, train_events, every):
+        train_error.append(1.0 - np.trace(weighted_confusion_matrix(train_class, pred))/len(pred))
+        train_predictions = pred
+
+    eff = np.array(eff)
+    return {'Stages': np.array(stages),
+            'TestError': np.array(test_error),
+            'TrainError': np.array(train_error),
+            'HSSSsqrtB': np.array(ssqrtb),
+            'BIBEff': eff[:,0], 'MJEff': eff[:,1], 'HSSEff': eff[:,2],
+            'TestClass': test_class, 'TestPredictions': test_predictions,
+            'TrainClass': train_class, 'TrainPredictions': train_predictions}
+
+@timed('staged_performance', rows=None)
+def staged_performance(bdt, events, classes, weights, every = 1):
+    '''Calculate the calc_performance table after every k-th boost, from a single walk over the stages.
+
+    Args
+        bdt - the trained BDT
+        events - the testing events (DataFrame of the training variables)
+        classes - array of the actual class of each event
+        weights - array of the event weights
+        every - only evaluate every k-th stage (the last stage is always evaluated)
+
+    Returns
+        list of (number of trees, performance table)
+    '''
+    classes = np.asarray(classes)
+    weights = np.asarray(weights, dtype=np.float64)
+    counts = np.bincount(classes.astype(np.intp), minlength=3)
+    return [(i_stage, performance_from_confusion_matrix(weighted_confusion_matrix(classes, pred, weights), counts))
+            for i_stage, pred in _staged_classes(bdt, events, every)]
+
+def plot_training_performance (bdt, training_sample, testing_sample, title_keyword, every = 1, training_variables = default_training_variable_list, curves = None):
     '''Generate a figure that shows training as a function of the number of trees and some quick info
     on the differences between test and training samples.
     
@@ -270,53 +623,52 @@ def plot_training_performance (bdt, training_sample, testing_sample, title_keywo
         bdt - the BDT we are testing
         training_sample - the tripple of training samples (bib, mj, hss) as treturned from test_train_samples
         testing_sample - the tripple of testing samples
+        every - only evaluate every k-th stage
+        training_variables - the variables the BDT was trained on
+        curves - already calculated training_curves (they are calculated if None)
         
     Returns
         fig - a figure
     '''
-
-    # Extract test and training events suitable to feeding to the bdt
-    test_events, test_events_class, test_weights, test_eval_weights = prep_samples(testing_sample[0], testing_sample[1], testing_sample[2])
-    train_events, train_events_class, training_weights, training_eval_weights = prep_samples(training_sample[0], training_sample[1], training_sample[2])
-
-    # Training performance looks at generic things - like has the tree settled down quickly or not.
-    test_errors = []
-    for test_predict in bdt.staged_predict(test_events):
-        test_errors.append(1.0 - accuracy_score(test_predict, test_events_class.Class))
-
-    n_trees = len(bdt)
-    estimator_errors = bdt.estimator_errors_[:n_trees]
-
-    # Compare training and testing prediction vs what we see.
-    test_predictions = bdt.predict(test_events)
-    train_predictions = bdt.predict(train_events)
+    import matplotlib.pyplot as plt
+    if curves is None:
+        curves = training_curves(bdt, training_sample, testing_sample, every, training_variables)
+    stages = curves['Stages']
     
     # Generate the figure to return
     fig = plt.figure(figsize=(15,15))
 
     ax = plt.subplot(221)
-    ax.plot(range(1, n_trees+1), test_errors, c='black')
+    ax.plot(stages, curves['TestError'], c='black')
     ax.set_ylim(0.0, 1.0)
     ax.set_ylabel('Test Error')
     ax.set_xlabel('Number of trees')
     ax.set_title('Test Error for {0} training'.format(title_keyword))
 
     ax = plt.subplot(222)
-    ax.plot(range(1,n_trees+1), estimator_errors, c='black', label="SAMME")
+    if hasattr(bdt, 'estimator_errors_'):
+        n_trees = len(bdt)
+        ax.plot(range(1,n_trees+1), bdt.estimator_errors_[:n_trees], c='black', label="SAMME")
+        ax.set_ylabel('Esitmator Error')
+        ax.set_title('Estimator Error for {0} training'.format(title_keyword))
+    else:
+        ax.plot(stages, curves['TrainError'], c='black', label="Train")
+        ax.plot(stages, curves['TestError'], c='red', label="Test")
+        ax.set_ylabel('Error')
+        ax.set_title('Train and Test Error for {0} training'.format(title_keyword))
+        ax.legend()
     ax.set_ylim(0, 1.0)
-    ax.set_ylabel('Esitmator Error')
     ax.set_xlabel('Number of trees')
-    ax.set_title('Estimator Error for {0} training'.format(title_keyword))
 
     ax = plt.subplot(223)
-    ax.hist([test_events_class.Class, test_predictions], label=["Actual", "Predicted by BDT"], bins=[0,1,2,3])
+    ax.hist([curves['TestClass'], curves['TestPredictions']], label=["Actual", "Predicted by BDT"], bins=[0,1,2,3])
     ax.set_xticks([0.5,1.5,2.5])
     ax.set_xticklabels(['BIB', 'MJ', 'HSS'])
     ax.set_title('Test Events: Prediction vs Actual for {0} training'.format(title_keyword))
     ax.legend()
 
     ax = plt.subplot(224)
-    ax.hist([train_events_class.Class, train_predictions], label=["Actual", "Predicted by BDT"], bins=[0,1,2,3])
+    ax.hist([curves['TrainClass'], curves['TrainPredictions']], label=["Actual", "Predicted by BDT"], bins=[0,1,2,3])
     ax.set_xticks([0.5,1.5,2.5])
     ax.set_xticklabels(['BIB', 'MJ', 'HSS'])
     ax.set_title('Train Events: Prediction vs Actual for {0} training'.format(title_keyword))
@@ -324,6 +676,49 @@ def plot_training_performance (bdt, training_sample, testing_sample, title_keywo
 
     return fig
 
+performance_labels = {0:'BIB', 1:'MJ', 2:'HSS'}
+
+def performance_from_confusion_matrix(m, class_counts):
+    '''Build the performance table from a weighted confusion matrix.
+
+    Args
+        m - 3x3 weighted confusion matrix, m[actual, predicted] (see weighted_confusion_matrix)
+        class_counts - the number of events of each actual class
+
+    Return
+        d - dict as returned by calc_performance_for_run
+    '''
+    labels = performance_labels
+    total_weight = np.sum(m, axis=1)
+    back = np.sum(m, axis=0) - np.diag(m)
+
+    d = {"{0}in{1}".format(labels[aclass], labels[pclass]):m[aclass, pclass] for pclass in (0,1,2) for aclass in (0,1,2)}
+
+    # Calculated quantities
+    d.update({'{0}Eff'.format(labels[aclass]):m[aclass, aclass]/total_weight[aclass] for aclass in (0,1,2)})
+    d.update({'{0}Back'.format(labels[aclass]):back[aclass] for aclass in (0,1,2)})
+    d.update({'{0}SsqrtB'.format(labels[aclass]):m[aclass, aclass]/np.sqrt(back[aclass]) for aclass in (0,1,2)})
+
+    d.update({'{0}TotalWeight'.format(labels[aclass]):total_weight[aclass] for aclass in (0,1,2)})
+    d.update({'{0}TotalCount'.format(labels[aclass]):class_counts[aclass] for aclass in (0,1,2)})
+    return d
+
+def calc_performance_for_arrays(classes, predictions, weights):
+    '''Same as calc_performance_for_run, but takes the arrays directly.
+
+    Args
+        classes - array of the actual class of each event
+        predictions - array of the predicted class of each event
+        weights - array of the event weights
+
+    Return
+        d - dict as returned by calc_performance_for_run
+    '''
+    classes = np.asarray(classes)
+    with stage('calc_performance_for_run', rows=len(classes)):
+        m = weighted_confusion_matrix(classes, predictions, np.asarray(weights, dtype=np.float64))
+        return performance_from_confusion_matrix(m, np.bincount(classes.astype(np.intp), minlength=3))
+
 def calc_performance_for_run(df):
     '''Given a data frame with the prediction and actual events, determine a set of numbers about it and return them.
     
@@ -333,23 +728,7 @@ def calc_performance_for_run(df):
     Return
         d - dict containing number of events of each type predicted for each time, and S/sqrt(B) for S as signal and B as mj+bib
     '''
-    # Next, for each sample, calculate what we need.
-    class_events = [df.Class == index for index in (0,1,2)]
-    pred_events = [df.PredClass == index for index in (0,1,2)]        
-    labels = {0:'BIB', 1:'MJ', 2:'HSS'}
-    
-    d = {"{0}in{1}".format(labels[aclass], labels[pclass]):np.sum((class_events[aclass]&pred_events[pclass])*df.Weight) for pclass in (0,1,2) for aclass in (0,1,2)}
-    
-    # Calculated quantities
-    
-    d.update({'{0}Eff'.format(labels[aclass]):np.sum((pred_events[aclass]&class_events[aclass])*df.Weight)/np.sum(class_events[aclass]*df.Weight) for aclass in (0,1,2)})
-    d.update({'{0}Back'.format(labels[aclass]):np.sum((pred_events[aclass]&(~class_events[aclass]))*df.Weight) for aclass in (0,1,2)})
-    d.update({'{0}SsqrtB'.format(labels[aclass]):(d['{0}in{0}'.format(labels[aclass])]/sqrt(d['{0}Back'.format(labels[aclass])])) for aclass in (0,1,2)})
-
-    d.update({'{0}TotalWeight'.format(labels[aclass]):np.sum(class_events[aclass]*df.Weight) for aclass in (0,1,2)})
-    d.update({'{0}TotalCount'.format(labels[aclass]):np.sum(class_events[aclass]) for aclass in (0,1,2)})
-    
-    return d
+    return calc_performance_for_arrays(df.Class.values, df.PredClass.values, df.Weight.values)
 
 def calc_performance (bdt, testing_samples, training_variables = default_training_variable_list):
     '''Calculate the nubers in each class, as well as S/sqrt(B) for HSS
@@ -365,11 +744,7 @@ def calc_performance (bdt, testing_samples, training_variables = default_trainin
     '''
     
     test_events, test_events_class, test_weights, test_eval_weights = prep_samples(testing_samples[0], testing_samples[1], testing_samples[2], training_variable_list = training_variables)
-    test_predictions = bdt.predict(test_events)
-    
-    # Assemble a single DataFrame with all the information we are going to need
-    df = pd.DataFrame(test_predictions, columns=['PredClass'])
-    df.loc[:,'Class'] = test_events_class
-    df.loc[:,'Weight'] = test_eval_weights
+    with stage('predict', rows=len(test_events.index)):
+        test_predictions = bdt.predict(test_events)
     
-    return calc_performance_for_run(df)
+    return calc_performance_for_arrays(test_events_class.Class.values, test_predictions, test_eval_weights.values)
@@ -0,0 +1,311 @@
+#
+# A reproducible benchmark of the whole pipeline on synthetic samples, to catch performance
+# regressions. The samples have the same columns as the real ones (training variables,
+# EventNumber, the weights, mc_Lxy/mc_Lz, JetEta) and the training job outputs have the
+# same all-<sample>.csv layout, so every stage runs the same code it does on real data.
+# They are generated from a fixed seed, so two runs of the same size see the same events.
+#
+# Each run appends its timings to a results file, one json line per run, along with the
+# commit and package versions, so runs from different versions of the code can be compared:
+#
+#   python benchmark_suite.py --sizes 10000 100000 --label before
+#   ... change things ...
+#   python benchmark_suite.py --sizes 10000 100000 --label after
+#   python benchmark_suite.py --compare before after
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from bdt_training_scikit_tools import default_training_variable_list, load_sample, get_fraction_of_events, \
+    test_train_samples, prep_samples, default_training, calc_performance
+from training_job_dumper import calc_roc_family, split_data_in_slices, training_job, init_render_worker, \
+    signal_sample_names, bib_sample_names, mj_sample_names
+from instrumentation import peak_memory_usage
+
+# The samples of a job, as load_default_samples finds them, and the class each one is generated as
+training_sample_names = {'bib16': 'bib', 'multijet': 'mj', 'signal': 'sig'}
+
+# How far each class is shifted along each training variable (in units of the spread)
+synthetic_class_shift = {'bib': -0.5, 'mj': 0.0, 'sig': 0.7}
+
+def synthetic_training_sample(n, kind, seed = 0, first_event = 0):
+    '''Generate a sample with the columns of the real training samples.
+
+    Every training variable is normally distributed, shifted by an amount that depends on the
+    class (and the variable), so a training has something to find. JetPt and the mc decay lengths
+    are exponential. The decay lengths are 0 for bib and multijet, as there is no LLP.
+
+    Args
+        n - number of events
+        kind - 'bib', 'mj', or 'sig'
+        seed - random seed
+        first_event - EventNumbers are first_event to first_event+n-1, shuffled
+
+    Returns
+        df - DataFrame with the default_training_variable_list columns, EventNumber, Weight, WeightMCEvent,
+             WeightXSection, mc_Lxy, mc_Lz and JetEta
+    '''
+    if kind not in synthetic_class_shift:
+        raise Exception("Unknown synthetic sample kind '{0}' (known: {1})".format(kind, list(synthetic_class_shift.keys())))
+    r = np.random.RandomState(seed)
+    shift = synthetic_class_shift[kind]
+    d = {}
+    for i, v in enumerate(default_training_variable_list):
+        d[v] = r.normal(shift*(1.0 + 0.5*np.sin(i)), 1.0, n)
+    d['JetPt'] = 40.0 + r.exponential(60.0*(1.0 + max(shift, 0.0)), n)
+    d['EventNumber'] = first_event + r.permutation(n).astype(np.int64)
+    d['Weight'] = r.uniform(0.5, 1.5, n)
+    d['WeightMCEvent'] = r.uniform(0.5, 1.5, n)
+    d['WeightXSection'] = np.full(n, 1.0 if kind == 'bib' else 1e-3)
+    d['JetEta'] = r.uniform(-2.5, 2.5, n)
+    d['mc_Lxy'] = r.exponential(2000.0, n) if kind == 'sig' else np.zeros(n)
+    d['mc_Lz'] = r.exponential(3000.0, n) if kind == 'sig' else np.zeros(n)
+    return pd.DataFrame(d)
+
+def synthetic_mva_sample(n, kind, seed = 0):
+    '''Generate the MVA output of a training job for one sample (as in all-<sample>.csv).
+
+    The three MVA weights add up to one, and are largest for the sample's own class.
+
+    Args
+        n - number of events
+        kind - 'bib', 'mj', or 'sig'
+        seed - random seed
+
+    Returns
+        df - DataFrame with Weight, HSSWeight, MultijetWeight and BIBWeight columns
+    '''
+    alpha = {'bib': [4, 1, 1], 'mj': [1, 4, 1], 'sig': [1, 1, 4]}[kind]
+    r = np.random.RandomState(seed)
+    w = r.dirichlet(alpha, n)
+    return pd.DataFrame({'Weight': r.uniform(0.5, 1.5, n), 'HSSWeight': w[:,2], 'MultijetWeight': w[:,1], 'BIBWeight': w[:,0]},
+                        columns=['Weight', 'HSSWeight', 'MultijetWeight', 'BIBWeight'])
+
+def write_synthetic_job(directory, n, nfiles = 2, seed = 0):
+    '''Write a synthetic job to disk.
+
+    Args
+        directory - where to write it. The training samples go in directory (bib16-*.csv,
+                    multijet-*.csv, signal-*.csv, as load_default_samples expects), and the
+                    training job outputs in directory/mva (all-<sample>.csv, as training_job expects).
+        n - number of events in each training sample and each MVA output sample (jz gets 3 times as many)
+        nfiles - number of csv files each training sample is split over
+
+    Returns
+        directory - the directory written
+    '''
+    mva_dir = os.path.join(directory, 'mva')
+    if not os.path.exists(mva_dir):
+        os.makedirs(mva_dir)
+
+    for i, (name, kind) in enumerate(training_sample_names.items()):
+        df = synthetic_training_sample(n, kind, seed*1000 + i, first_event = i*n)
+        for k, part in enumerate(np.array_split(np.arange(n), nfiles)):
+            df.iloc[part].to_csv(os.path.join(directory, "{0}-{1}.csv".format(name, k)), index=False)
+
+    mva_samples = [(s, 'sig', 1) for s in signal_sample_names] + [(s, 'bib', 1) for s in bib_sample_names] + [(s, 'mj', 3) for s in mj_sample_names]
+    for i, (name, kind, scale) in enumerate(mva_samples):
+        synthetic_mva_sample(n*scale, kind, seed*1000 + 100 + i).to_csv(os.path.join(mva_dir, "all-{0}.csv".format(name)), index=False)
+    return directory
+
+def time_stage(results, name, function, repeats = 1, rows = None):
+    '''Run a stage repeats times and add its best time to results.
+
+    Args
+        results - list of stage results to add to
+        name - the stage name
+        function - called with no arguments
+        rows - number of rows the stage works on (for the rate)
+
+    Returns
+        the value returned by the last call of function
+    '''
+    walls = []
+    cpus = []
+    for i in range(repeats):
+        wall_start = time.time()
+        cpu_start = time.process_time()
+        value = function()
+        cpus.append(time.process_time() - cpu_start)
+        walls.append(time.time() - wall_start)
+    peak = peak_memory_usage()
+    results.append({'Stage': name, 'Wall': min(walls), 'CPU': min(cpus),
+                    'PeakRSS': None if peak is None else peak/1024.0/1024.0,
+                    'Rows': rows, 'RowsPerSecond': None if rows is None else rows/max(min(walls), 1e-9)})
+    print ("  {0}: {1:.3f} s".format(name, min(walls)))
+    return value
+
+def benchmark_pipeline(directory, n, estimators = 100, backend = None, fraction = 0.5, workers = None, repeats = 1):
+    '''Time each stage of the pipeline on a synthetic job written by write_synthetic_job.
+
+    Args
+        directory - the synthetic job
+        n - number of events in each sample of the job (for the rates)
+        estimators, backend - passed on to default_training
+        fraction - fraction of the events get_fraction_of_events keeps
+        workers - number of processes training_job renders with
+        repeats - run each of the quick stages this many times and keep the best. The training
+                  and training_job are only run once.
+
+    Returns
+        list of dicts, one per stage, with Stage, Wall, CPU (seconds), PeakRSS (MB, of this process
+        so far), Rows and RowsPerSecond
+    '''
+    results = []
+    names = list(training_sample_names)
+    samples = time_stage(results, 'load_sample', lambda: [load_sample(os.path.join(directory, s)) for s in names], repeats, 3*n)
+    cache_root = os.path.join(directory, '.sample_cache')
+    time_stage(results, 'load_sample_cache_build', lambda: [load_sample(os.path.join(directory, s), use_cache=True, cache_root=cache_root) for s in names], 1, 3*n)
+    time_stage(results, 'load_sample_cached', lambda: [load_sample(os.path.join(directory, s), use_cache=True, cache_root=cache_root) for s in names], repeats, 3*n)
+
+    time_stage(results, 'get_fraction_of_events', lambda: get_fraction_of_events(samples, fraction), repeats, 3*n)
+    train, test = test_train_samples(samples)
+    train_rows = sum(len(s.index) for s in train)
+    events, events_class, training_weight, evaluation_weight = time_stage(results, 'prep_samples',
+        lambda: prep_samples(train[0], train[1], train[2]), repeats, train_rows)
+
+    bdt = time_stage(results, 'default_training', lambda: default_training(events, training_weight, events_class, estimators=estimators, backend=backend),
+                     1, train_rows)
+    time_stage(results, 'calc_performance', lambda: calc_performance(bdt, test), repeats, sum(len(s.index) for s in test))
+
+    mva_dir = os.path.join(directory, 'mva')
+    mva = {s: pd.read_csv(os.path.join(mva_dir, "all-{0}.csv".format(s))) for s in signal_sample_names + bib_sample_names + mj_sample_names}
+    sig = mva[signal_sample_names[0]]
+    back = mva[mj_sample_names[0]]
+    bib = [mva[s] for s in bib_sample_names]
+    time_stage(results, 'calc_roc_family', lambda: calc_roc_family(sig, back, bib), repeats, len(sig.index) + len(back.index))
+    time_stage(results, 'split_data_in_slices', lambda: split_data_in_slices(back, 'HSSWeight'), repeats, len(back.index))
+
+    output_dir = tempfile.mkdtemp(prefix='benchmark-plots-')
+    try:
+        total_mva_rows = sum(len(s.index) for s in mva.values())
+        time_stage(results, 'training_job', lambda: training_job(mva_dir, output_dir, 'bench', workers), 1, total_mva_rows)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+def git_commit():
+    '''The commit of the code being benchmarked (with a + if there are local changes), or None'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if len(dirty) != 0 else '')
+
+def environment_info():
+    '''What the results depend on besides the code: machine and package versions'''
+    import sklearn
+    return {'Host': socket.gethostname(), 'Platform': platform.platform(), 'CPUs': os.cpu_count(),
+            'Python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'sklearn': sklearn.__version__}
+
+def run_benchmarks(sizes = (10000, 100000), results_path = 'benchmark_results.json', label = None, estimators = 100,
+                   backend = None, workers = None, repeats = 3, seed = 0, work_dir = None):
+    '''Generate a synthetic job at each size, time the pipeline on it, and append the run to results_path.
+
+    Args
+        sizes - list of the number of events in each sample
+        results_path - file the runs are appended to (one json line per run). None to not save.
+        label - name for this run, to pick it out in compare_benchmark_runs (defaults to the commit)
+        estimators, backend, workers, repeats - see benchmark_pipeline
+        seed - random seed for the synthetic samples. Keep it fixed to compare runs.
+        work_dir - where to write the synthetic jobs. A temporary directory (removed afterwards) by default.
+
+    Returns
+        df - DataFrame with a row per size and stage
+    '''
+    commit = git_commit()
+    run = {'Label': label if label is not None else commit, 'Commit': commit, 'Time': time.time(),
+           'Environment': environment_info(),
+           'Config': {'Estimators': estimators, 'Backend': backend, 'Workers': workers, 'Repeats': repeats, 'Seed': seed},
+           'Results': []}
+
+    own_dir = work_dir is None
+    work_dir = tempfile.mkdtemp(prefix='benchmark-') if own_dir else work_dir
+    try:
+        for n in sizes:
+            print ("Size {0}".format(n))
+            job_dir = write_synthetic_job(os.path.join(work_dir, "job-{0}".format(n)), n, seed=seed)
+            run['Results'] += [dict(r, Size=n) for r in benchmark_pipeline(job_dir, n, estimators, backend, workers=workers, repeats=repeats)]
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if results_path is not None:
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+    return pd.DataFrame(run['Results'])
+
+def load_benchmark_results(results_path = 'benchmark_results.json'):
+    '''Read all the runs in a results file.
+
+    Returns
+        df - DataFrame with a row per run, size and stage (Label, Commit, Time, Size, Stage, Wall, CPU, PeakRSS, Rows, RowsPerSecond)
+    '''
+    rows = []
+    with open(results_path, 'r') as f:
+        for line in f:
+            if len(line.strip()) != 0:
+                run = json.loads(line)
+                rows += [dict(r, Label=run['Label'], Commit=run['Commit'], Time=run['Time']) for r in run['Results']]
+    return pd.DataFrame(rows, columns=['Label', 'Commit', 'Time', 'Size', 'Stage', 'Wall', 'CPU', 'PeakRSS', 'Rows', 'RowsPerSecond'])
+
+def compare_benchmark_runs(baseline, current, results_path = 'benchmark_results.json', value = 'Wall'):
+    '''Compare two runs stage by stage. If a label was used for more than one run, the latest is taken.
+
+    Args
+        baseline - label of the run to compare against
+        current - label of the new run
+        value - which number to compare (Wall, CPU, PeakRSS...)
+
+    Returns
+        df - DataFrame indexed by (Size, Stage) with the baseline value, the current value, and their ratio
+             (current/baseline, so above 1 is slower for times)
+    '''
+    df = load_benchmark_results(results_path)
+    def pick(label):
+        runs = df[df.Label == label]
+        if len(runs.index) == 0:
+            raise Exception("No benchmark run labeled '{0}' in {1}".format(label, results_path))
+        return runs[runs.Time == runs.Time.max()].set_index(['Size', 'Stage'])[value]
+    r = pd.DataFrame({'Baseline': pick(baseline), 'Current': pick(current)})
+    r['Ratio'] = r.Current/r.Baseline
+    return r
+
+# If invoked from main
+def main(args):
+    parser = argparse.ArgumentParser(description='Time the training and plotting pipeline on synthetic samples.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Number of events in each sample')
+    parser.add_argument('--results', default='benchmark_results.json', help='File the results are appended to')
+    parser.add_argument('--label', default=None, help='Name of this run (defaults to the commit)')
+    parser.add_argument('--estimators', type=int, default=100, help='Number of boosts in the training')
+    parser.add_argument('--backend', default=None, help='Training backend (see training_backends)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes that render the plots')
+    parser.add_argument('--repeats', type=int, default=3, help='Run each quick stage this many times and keep the best')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic samples')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), default=None,
+                        help='Compare two runs already in the results file instead of running')
+    a = parser.parse_args(args)
+
+    if a.compare is not None:
+        print (compare_benchmark_runs(a.compare[0], a.compare[1], a.results).to_string())
+        return
+
+    init_render_worker()
+    print (run_benchmarks(a.sizes, a.results, a.label, a.estimators, a.backend, a.workers, a.repeats, a.seed).to_string())
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
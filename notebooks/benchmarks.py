@@ -0,0 +1,237 @@
+#
+# Timing studies for the training and plotting tools. Meant to be run from a notebook
+# against a real job's samples, e.g.
+#
+#   from benchmarks import compare_training_backends
+#   compare_training_backends(load_trimmed_sample(job))
+#
+
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+
+from bdt_training_scikit_tools import default_training_variable_list, test_train_samples, \
+    prep_samples, default_training, calc_performance, fraction_mask
+from training_job_dumper import calc_roc_with_bib_cut, calc_roc_family, job_plot_data, streaming_job_plot_data
+from compiled_bdt import export_bdt
+
+def compare_training_backends(all_events, backends = ('exact', 'hist'), estimators = 1000, event_mod = 3,
+                              training_variable_list = default_training_variable_list):
+    '''Train with each backend on the same training/testing split, and compare the
+    time it takes and the performance of the result.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        backends - list of training backends to run (see training_backends)
+        estimators - number of boosts for each training
+        event_mod - the EventNumber modulus used to split testing and training
+        training_variable_list - variables to train on
+
+    Returns
+        df - DataFrame indexed by backend, with the fit and evaluation wall time in seconds,
+             and the calc_performance numbers.
+    '''
+    train, test = test_train_samples(all_events, event_mod)
+    events, events_class, training_weight, evaluation_weight = prep_samples(train[0], train[1], train[2], training_variable_list=training_variable_list)
+
+    results = {}
+    for backend in backends:
+        start = time.time()
+        bdt = default_training(events, training_weight, events_class, estimators=estimators, backend=backend)
+        fit_time = time.time() - start
+
+        start = time.time()
+        d = calc_performance(bdt, test, training_variables=training_variable_list)
+        d['FitTime'] = fit_time
+        d['EvalTime'] = time.time() - start
+        results[backend] = d
+
+    return pd.DataFrame(results).T
+
+# The divisor based sub-sampling get_fraction_of_events used before fraction_mask, kept here to benchmark against.
+def _original_fraction(fractionGoal):
+    seq = ()
+    fg = fractionGoal
+    maxCount = 300
+    for i in range(1, maxCount):
+        frac = 1.0/i
+        if frac <= fg:
+            seq = seq + (i,)
+            remainingSequence = [i for i in range(maxCount) if len([j for j in seq if i%j == 0]) != 0]
+            actualFraction = len(remainingSequence)/maxCount
+            fg = fractionGoal - actualFraction
+    return seq
+
+def _original_filter(df, seq):
+    gf, *gfRest = [df.EventNumber%i==0 for i in seq]
+    for g in gfRest:
+        gf = gf | g
+    return gf
+
+def compare_fraction_methods(sample, fractions = (0.01, 0.1, 0.25, 0.5, 0.9)):
+    '''Compare the original divisor based sub-sampling with fraction_mask.
+
+    Args
+        sample - a DataFrame with an EventNumber column
+        fractions - the fractions to ask for
+
+    Returns
+        df - DataFrame indexed by the requested fraction, with the fraction each method
+             actually kept and the time each took in seconds.
+    '''
+    results = {}
+    for f in fractions:
+        start = time.time()
+        old_mask = _original_filter(sample, _original_fraction(f))
+        old_time = time.time() - start
+
+        start = time.time()
+        new_mask = fraction_mask(sample.EventNumber.values, f)
+        new_time = time.time() - start
+
+        results[f] = {'OldFraction': np.mean(old_mask), 'OldTime': old_time,
+                      'NewFraction': np.mean(new_mask), 'NewTime': new_time}
+
+    return pd.DataFrame(results).T
+
+def compare_roc_family_methods(sig, back, bib, bib_cut_range = np.logspace(-3,0,30)):
+    '''Compare calc_roc_family with running calc_roc_with_bib_cut for each bib cut (the old way).
+
+    Args
+        sig - signal DataFrame of MVA outputs
+        back - background (jz) DataFrame
+        bib - bib DataFrame
+
+    Returns
+        d - dict with the time each method took, and if they gave the same curves
+    '''
+    sorted_bib_values = bib['BIBWeight'].sort_values()
+    lst_len = len(sorted_bib_values.index)-1
+    bib_cut_values = [sorted_bib_values.values[index] for index in [int(lst_len*cut_fraction) for cut_fraction in bib_cut_range]]
+
+    start = time.time()
+    old = [calc_roc_with_bib_cut(sig, back, bib, bib_cut = bc)+(bc,) for bc in bib_cut_values]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = calc_roc_family(sig, back, bib, bib_cut_range)
+    new_time = time.time() - start
+
+    same = all(np.allclose(o[0], n.tpr) and np.allclose(o[1], n.fpr) and np.allclose(o[2:], [n.aroc, n.sig_eff, n.back_eff, n.bib_eff, n.bib_cut])
+               for o, (i, n) in zip(old, new.iterrows()))
+    return {'OldTime': old_time, 'NewTime': new_time, 'Same': same}
+
+def compare_streaming_bib_cuts(jobdir, chunksize = 100000, bib_quantile_bins = 100000):
+    '''Check that the bib cuts and bib efficiencies of the streaming (chunked) job plot data agree
+    with the in-memory ones. The streaming cuts come from a histogram of the bib values, so they can
+    be off by up to a bin width.
+
+    Args
+        jobdir - location of the job csv files
+        chunksize - rows to read at a time for the streaming version
+        bib_quantile_bins - bins in the streaming bib histogram
+
+    Returns
+        d - dict with the time each took, the largest difference in the bib cuts and bib efficiencies,
+            and if they agree to within a bin
+    '''
+    start = time.time()
+    old = job_plot_data(jobdir)[2]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = streaming_job_plot_data(jobdir, chunksize, bib_quantile_bins = bib_quantile_bins)[2]
+    new_time = time.time() - start
+
+    cut_difference = max(np.max(np.abs(old[s].bib_cut.values - new[s].bib_cut.values)) for s in old)
+    eff_difference = max(np.max(np.abs(old[s].bib_eff.values - new[s].bib_eff.values)) for s in old)
+    return {'OldTime': old_time, 'NewTime': new_time, 'MaxCutDifference': float(cut_difference),
+            'MaxEffDifference': float(eff_difference), 'Same': bool(set(old) == set(new) and cut_difference <= 1.0/bib_quantile_bins)}
+
+def compare_bdt_inference(bdt, events):
+    '''Compare scoring events with the sklearn BDT and with its exported FlatForest.
+
+    Args
+        bdt - trained BDT from default_training
+        events - DataFrame of the training variables to score
+
+    Returns
+        d - dict with the time each took, events per second, and the largest difference in the decision function
+    '''
+    start = time.time()
+    forest = export_bdt(bdt)
+    export_time = time.time() - start
+
+    start = time.time()
+    old = bdt.decision_function(events)
+    old_time = time.time() - start
+
+    start = time.time()
+    new = forest.decision_function(events)
+    new_time = time.time() - start
+
+    return {'ExportTime': export_time, 'OldTime': old_time, 'NewTime': new_time,
+            'OldRate': len(events)/old_time, 'NewRate': len(events)/new_time,
+            'MaxDifference': np.max(np.abs(old - new))}
+
+# Run in a fresh interpreter: import a module, and report how long it took and what it pulled in.
+_startup_probe = '''
+import sys, time, json
+start = time.time()
+import {module}
+import_time = time.time() - start
+if sys.platform.startswith('linux'):
+    # ru_maxrss can carry over the peak of the parent process, VmHWM is just this program's.
+    with open('/proc/self/status') as f:
+        rss = [int(l.split()[1])*1024 for l in f if l.startswith('VmHWM:')][0]
+else:
+    import psutil
+    info = psutil.Process().memory_info()
+    rss = getattr(info, 'peak_wset', info.rss)
+print(json.dumps({{'ImportTime': import_time, 'PeakRSS': rss,
+                  'matplotlib': 'matplotlib' in sys.modules, 'sklearn': 'sklearn' in sys.modules}}))
+'''
+
+def measure_startup(modules = ('bdt_training_scikit_tools', 'get_training_performance', 'training_job_dumper'), repeats = 3):
+    '''Measure what a new process (e.g. a pool worker) pays to import each module.
+
+    Each import is done in a fresh python, started in the directory of these modules.
+    The baseline row is a python that imports nothing extra.
+
+    Args
+        modules - the modules to import
+        repeats - number of times to start each one (the fastest time is kept, as later
+                  runs have the files in the disk cache)
+
+    Returns
+        df - DataFrame indexed by module, with the import time in seconds, the peak resident
+             memory in MB, and whether matplotlib and sklearn were loaded
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for m in ('sys',) + tuple(modules):
+        runs = [json.loads(subprocess.check_output([sys.executable, '-c', _startup_probe.format(module=m)], cwd=directory).decode('utf-8'))
+                for i in range(repeats)]
+        r = min(runs, key=lambda r: r['ImportTime'])
+        r['PeakRSS'] = r['PeakRSS']/1024.0/1024.0
+        results['baseline' if m == 'sys' else m] = r
+    return pd.DataFrame(results).T
+
+def measure_pool_startup(processes = 4, repeats = 3):
+    '''Time starting a headless training pool and running a trivial task on every worker'''
+    from get_training_performance import headless_pool
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        pool = headless_pool(processes)
+        try:
+            pool.map(abs, range(processes))
+        finally:
+            pool.close()
+            pool.join()
+        times.append(time.time() - start)
+    return {'Processes': processes, 'StartTime': min(times)}
@@ -1,21 +1,226 @@
 from bdt_training_scikit_tools import load_default_samples, default_training_variable_list, \
-    test_train_samples, prep_samples, default_training, calc_performance
-    
+    test_train_samples, prep_samples, default_training, calc_performance, calc_performance_for_arrays
+from instrumentation import profiled, stage, timed
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+def init_headless_worker():
+    '''Pool worker initializer: workers never draw, so make sure that if anything does pull
+    in matplotlib it gets the non-interactive backend rather than a GUI one. A forked worker
+    may already have matplotlib loaded from its parent, so switch that over too.'''
+    os.environ['MPLBACKEND'] = 'Agg'
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].use('Agg', force=True)
+
+def headless_pool(processes = None):
+    '''Create a multiprocessing pool for training workers (see init_headless_worker).
+    MPLBACKEND is also set while the pool starts, so workers that are spawned fresh import
+    matplotlib headless from the start. The parent's own setting is put back afterwards.'''
+    old_backend = os.environ.get('MPLBACKEND')
+    os.environ['MPLBACKEND'] = 'Agg'
+    try:
+        return mp.Pool(processes=processes, initializer=init_headless_worker)
+    finally:
+        if old_backend is None:
+            del os.environ['MPLBACKEND']
+        else:
+            os.environ['MPLBACKEND'] = old_backend
+
 def do_training (vlist):
     all_events, training_list = vlist
     return get_training_performance (all_events, training_list)
-    
+
 def get_training_performance (all_events, training_list):
     '''Run a training with the set of varaibles given. Return a performance table.'''
-    
+
     # Split into testing and training samples
     train, test = test_train_samples(all_events)
-        
+
     # Prep samples for training
     all_events, all_events_class, training_weight, evaluation_weight = prep_samples(train[0], train[1], train[2], training_variable_list=training_list)
-    
+
     # Run training
     bdt = default_training(all_events, training_weight, all_events_class, estimators=400)
-    
+
     # Create a thing of all the results
-    return {tuple(training_list): calc_performance(bdt, test, training_variables = training_list)}
\ No newline at end of file
+    return {tuple(training_list): calc_performance(bdt, test, training_variables = training_list)}
+
+# The arrays a process has already attached to, by directory
+_attached_training_data = {}
+
+class SharedTrainingData:
+    '''The (bib, mj, sig) events written once to memory-mapped files.
+
+    The handle itself only holds the location of the files, so it is cheap to send
+    to pool workers. Each worker maps the files read-only, and all the workers share
+    the same physical memory for the data.
+    '''
+    def __init__(self, directory, variables):
+        self.directory = directory
+        self.variables = list(variables)
+
+    def load(self):
+        '''Return the (features, classes, training weights, evaluation weights, event numbers) arrays.
+        The features are a matrix with one column for each of the variables, with the type of the
+        events that were shared (float64, or float32 for a downcast sample).
+        '''
+        if self.directory not in _attached_training_data:
+            _attached_training_data[self.directory] = tuple(np.load(os.path.join(self.directory, "{0}.npy".format(n)), mmap_mode='r')
+                for n in ('features', 'classes', 'training_weight', 'evaluation_weight', 'event_number'))
+        return _attached_training_data[self.directory]
+
+    def columns(self, training_list):
+        '''Return the column indices in the feature matrix for a list of variables'''
+        return [self.variables.index(v) for v in training_list]
+
+    def cleanup(self):
+        '''Remove the files from disk'''
+        _attached_training_data.pop(self.directory, None)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+@timed('share_training_data', rows=None)
+def share_training_data(all_events, variables = default_training_variable_list, directory = None):
+    '''Write the events out once so that training workers can attach to them without a copy.
+
+    Args
+        all_events - the tripple of (bib, mj, sig) events
+        variables - all the variables any of the trainings might use
+        directory - where to write the files. A temporary directory is created by default.
+
+    Returns
+        shared - SharedTrainingData handle to pass to the workers
+    '''
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='training-data-')
+    events, events_class, training_weight, evaluation_weight = prep_samples(all_events[0], all_events[1], all_events[2], training_variable_list=variables)
+    event_number = np.concatenate([s.EventNumber.values for s in all_events])
+
+    # The values are kept as they are: the 'exact' trees would see the same thing in float32, but
+    # HistGradientBoosting bins the values it is given, so float32 would change the 'hist' trainings.
+    # Column order makes picking out a few variables fast.
+    np.save(os.path.join(directory, 'features.npy'), np.asfortranarray(events.values))
+    np.save(os.path.join(directory, 'classes.npy'), events_class.Class.values)
+    np.save(os.path.join(directory, 'training_weight.npy'), training_weight.values)
+    np.save(os.path.join(directory, 'evaluation_weight.npy'), evaluation_weight.values)
+    np.save(os.path.join(directory, 'event_number.npy'), event_number)
+
+    return SharedTrainingData(directory, variables)
+
+def get_shared_training_performance (shared, training_list, event_mod = 3, estimators = 400, backend = None):
+    '''Run a training with the set of variables given using the shared events. Return a performance table.
+
+    The split into training and testing, and the training itself, are the same as get_training_performance.
+    '''
+    return {tuple(training_list): get_shared_fold_performance(shared, training_list, 0, event_mod, estimators, backend)}
+
+def get_shared_fold_performance (shared, training_list, fold, k, estimators = 400, backend = None):
+    '''Train on all events but those with EventNumber % k == fold, and test on those.
+
+    Returns
+        d - the calc_performance table for the testing events
+    '''
+    features, classes, training_weight, evaluation_weight, event_number = shared.load()
+    columns = shared.columns(training_list)
+    in_fold = event_number % k == fold
+    train = np.flatnonzero(~in_fold)
+    test = np.flatnonzero(in_fold)
+
+    # Run training
+    train_events = pd.DataFrame(features[np.ix_(train, columns)], columns=training_list)
+    train_class = pd.DataFrame(classes[train], columns=['Class'])
+    bdt = default_training(train_events, training_weight[train], train_class, estimators=estimators, backend=backend, event_mod=k)
+
+    # Evaluate on the testing events
+    test_events = pd.DataFrame(features[np.ix_(test, columns)], columns=training_list)
+    with stage('predict', rows=len(test)):
+        predictions = bdt.predict(test_events)
+    return calc_performance_for_arrays(classes[test], predictions, evaluation_weight[test])
+
+def do_shared_training (vlist):
+    shared, training_list, *config = vlist
+    return get_shared_training_performance (shared, training_list, **(config[0] if len(config) > 0 else {}))
+
+def scan_training_performance (all_events, training_lists, pool = None, processes = 10, profile_prefix = None):
+    '''Run a training for each list of variables in parallel, sharing the events between the workers.
+
+    Args
+        all_events - the tripple of (bib, mj, sig) events
+        training_lists - list of variable lists, one training per list
+        pool - a multiprocessing pool to use. If None one is created (and closed) with processes workers.
+        processes - number of workers if we create the pool
+        profile_prefix - if given, record the time spent in each stage, in this process and the
+                         workers, and write a report to files starting with this (see instrumentation.profiled)
+
+    Returns
+        d - dict of performance tables, indexed by the tuple of variables, as from get_training_performance
+    '''
+    variables = []
+    for tl in training_lists:
+        variables = variables + [v for v in tl if v not in variables]
+
+    with profiled(profile_prefix):
+        shared = share_training_data(all_events, variables)
+        own_pool = pool is None
+        try:
+            if own_pool:
+                pool = headless_pool(processes)
+            results = pool.map(do_shared_training, [(shared, tl) for tl in training_lists])
+        finally:
+            if own_pool and pool is not None:
+                pool.close()
+                pool.join()
+            shared.cleanup()
+
+    one_dict = {}
+    for kp in results:
+        one_dict.update(kp)
+    return one_dict
+
+def do_shared_fold (vlist):
+    shared, training_list, fold, k, config = vlist
+    return get_shared_fold_performance (shared, training_list, fold, k, **config)
+
+def kfold_training_performance (all_events, training_list = default_training_variable_list, k = 3, estimators = 400, backend = None,
+                                pool = None, processes = None, profile_prefix = None):
+    '''Run k trainings, each one tested on a different EventNumber % k fold, in parallel.
+
+    Fold 0 is the same split as test_train_samples with event_mod = k. The events are written
+    once (see share_training_data) and every worker maps the same copy.
+
+    Args
+        all_events - the tripple of (bib, mj, sig) events
+        training_list - the variables to train on
+        k - number of folds
+        estimators, backend - passed on to default_training
+        pool - a multiprocessing pool to use. If None one is created (and closed) with processes workers.
+        processes - number of workers if we create the pool. None means one per fold, up to the number of cores.
+        profile_prefix - if given, write a report of the time spent in each stage (see scan_training_performance)
+
+    Returns
+        d - dict with:
+            Folds - list of the calc_performance tables, one per fold
+            Mean - the mean of each entry over the folds
+            Spread - the standard deviation of each entry over the folds
+    '''
+    with profiled(profile_prefix):
+        shared = share_training_data(all_events, training_list)
+        own_pool = pool is None
+        try:
+            if own_pool:
+                pool = headless_pool(min(k, mp.cpu_count()) if processes is None else processes)
+            folds = pool.map(do_shared_fold, [(shared, training_list, fold, k, {'estimators': estimators, 'backend': backend}) for fold in range(k)])
+        finally:
+            if own_pool and pool is not None:
+                pool.close()
+                pool.join()
+            shared.cleanup()
+
+    table = pd.DataFrame(folds)
+    return {'Folds': folds,
+            'Mean': table.mean().to_dict(),
+            'Spread': table.std().to_dict()}
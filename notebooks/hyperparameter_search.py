@@ -0,0 +1,208 @@
+#
+# Successive halving / Hyperband search over the BDT training parameters.
+# Every configuration is first trained on a small fraction of the training events. Only the
+# best ones are re-trained on larger fractions, and only the last few see the full sample.
+# Each fit is scored at many numbers of trees from its staged predictions, so n_estimators
+# doesn't have to be part of the grid. All trials are written to a log file as they finish,
+# and a search that is re-run (or was interrupted) picks up the trials from the log.
+#
+#   configs = parameter_grid({'max_depth': [2, 3, 4, 5], 'learning_rate': [0.05, 0.1, 0.2]})
+#   log = hyperband(all_events, configs, log_path='gbc_search.json')
+#
+
+import os
+import json
+import math
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+from bdt_training_scikit_tools import default_training_variable_list, fraction_masks, fit_or_load, staged_performance, \
+    gradient_boosting_classifier
+from get_training_performance import share_training_data, headless_pool
+from variable_selection import data_fingerprint
+
+# Parameters that are used unless a configuration sets them
+default_search_parameters = {'max_depth': 3, 'n_estimators': 1000}
+
+def parameter_grid(grid):
+    '''Return every combination of a dict of parameter name to list of values, as a list of dicts'''
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+
+class SearchLog:
+    '''Results of the trials that have already been run, kept in a file with one json line per trial'''
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if len(line.strip()) != 0:
+                        r = json.loads(line)
+                        self.results[r['key']] = r
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+    def add(self, key, trial):
+        '''Record a trial, and write it to disk right away'''
+        trial = dict(trial, key=key)
+        self.results[key] = trial
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(trial) + '\n')
+
+def trial_key(params, fraction, training_list, event_mod, every, fingerprint):
+    '''The log key of a trial: the parameters, the training sample, and the data. The fraction is rounded to
+    10 significant digits, so the same rung reached by a different chain of multiplications gets the same key.'''
+    k = json.dumps([sorted(params.items()), '{0:.10g}'.format(fraction), list(training_list), event_mod, every, fingerprint])
+    return hashlib.sha1(k.encode('utf-8')).hexdigest()
+
+def run_trial(shared, training_list, params, fraction, event_mod = 3, every = 10, metric = 'HSSSsqrtB'):
+    '''Train one configuration on a fraction of the training events, and score it on all the testing events.
+
+    Args
+        shared - SharedTrainingData with the events
+        training_list - variables to train on
+        params - GradientBoostingClassifier parameters
+        fraction - fraction of the training events to use (the same events as get_fraction_of_events picks)
+        event_mod - EventNumber modulus that splits off the testing events
+        every - score the fit after every k-th tree
+        metric - the calc_performance entry to record
+
+    Returns
+        trial - dict with the Stages that were scored and the metric at each one
+    '''
+    features, classes, training_weight, evaluation_weight, event_number = shared.load()
+    columns = shared.columns(training_list)
+    is_train = event_number % event_mod != 0
+
+    # Pick the events sample by sample, as get_fraction_of_events does
+    in_fraction = np.zeros(len(event_number), dtype=bool)
+    samples = [np.flatnonzero(classes == c) for c in np.unique(classes)]
+    for rows, mask in zip(samples, fraction_masks([event_number[rows] for rows in samples], fraction)):
+        in_fraction[rows] = mask
+    train = np.flatnonzero(is_train & in_fraction)
+    test = np.flatnonzero(~is_train)
+
+    train_events = pd.DataFrame(features[np.ix_(train, columns)], columns=training_list)
+    train_class = pd.DataFrame(classes[train], columns=['Class'])
+    bdt = fit_or_load(gradient_boosting_classifier(**params), train_events, training_weight[train], train_class,
+                      fraction=fraction, event_mod=event_mod)
+
+    test_events = pd.DataFrame(features[np.ix_(test, columns)], columns=training_list)
+    stages = staged_performance(bdt, test_events, classes[test], evaluation_weight[test], every)
+    return {'Params': params, 'Fraction': fraction, 'Events': len(train),
+            'Stages': [s for s, d in stages], metric: [float(d[metric]) for s, d in stages]}
+
+def do_trial(args):
+    return run_trial(*args)
+
+def ranking_score(score):
+    '''A score to rank trials by: NaN and +-inf count as the worst possible. S/sqrt(B) is +inf when
+    there is no background left, which happens on small samples and says nothing good about the fit.'''
+    return np.nan_to_num(np.asarray(score, dtype=np.float64), nan=-np.inf, posinf=-np.inf)
+
+def best_stage(trial, metric = 'HSSSsqrtB'):
+    '''Return (number of trees, metric) for the best point of a trial'''
+    scores = ranking_score(trial[metric])
+    index = int(np.argmax(scores))
+    return (trial['Stages'][index], trial[metric][index])
+
+def run_rung(shared, fingerprint, log, configs, fraction, training_list, event_mod, every, metric, pool):
+    '''Run (or fetch from the log) the trials for a list of configurations at one fraction'''
+    keys = [trial_key(c, fraction, training_list, event_mod, every, fingerprint) for c in configs]
+    todo = list({k: c for k, c in zip(keys, configs) if k not in log}.items())
+    if len(todo) != 0:
+        trials = pool.imap(do_trial, [(shared, training_list, c, fraction, event_mod, every, metric) for k, c in todo])
+        for (k, c), trial in zip(todo, trials):
+            log.add(k, trial)
+    return [log[k] for k in keys]
+
+def successive_halving(shared, fingerprint, log, configs, min_fraction, eta, training_list, event_mod, every, metric, pool, bracket = 0):
+    '''Run one bracket: all configs at min_fraction, then the best 1/eta of them at eta times
+    the fraction, and so on, until the full training sample.
+
+    Returns
+        history - list of dicts, one per trial, with the bracket and rung it was run in
+    '''
+    history = []
+    fraction = min_fraction
+    rung = 0
+    while True:
+        trials = run_rung(shared, fingerprint, log, configs, fraction, training_list, event_mod, every, metric, pool)
+        for c, t in zip(configs, trials):
+            stage, score = best_stage(t, metric)
+            history.append({'Bracket': bracket, 'Rung': rung, 'Fraction': fraction, 'Events': t['Events'],
+                            'Params': json.dumps(c, sort_keys=True), 'BestEstimators': stage, metric: score})
+        if fraction >= 1.0:
+            break
+        keep = max(1, len(configs) // eta)
+        order = np.argsort([-ranking_score(best_stage(t, metric)[1]) for t in trials], kind='mergesort')
+        configs = [configs[i] for i in order[:keep]]
+        rung += 1
+        # Snap to the full sample, so rounding doesn't leave us just short of it
+        fraction = min_fraction*eta**rung
+        fraction = 1.0 if fraction > 1.0 - 1e-9 else fraction
+    return history
+
+def hyperband(all_events, configs, training_list = default_training_variable_list, log_path = 'hyperparameter_search.json',
+              min_fraction = 1.0/27, eta = 3, event_mod = 3, every = 10, metric = 'HSSSsqrtB', brackets = None,
+              seed = 0, pool = None, processes = 10):
+    '''Search over the configurations with Hyperband: a set of successive halving brackets, each
+    starting from a different fraction of the events (from min_fraction up to the full sample),
+    trading how many configurations are tried against how much data each one sees at first.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        configs - list of GradientBoostingClassifier parameter dicts to pick from (see parameter_grid).
+                  default_search_parameters fills in anything not given - n_estimators is the
+                  largest number of trees that will be scored.
+        training_list - variables to train on
+        log_path - file where the trials are remembered between runs (None to not keep them)
+        min_fraction - the smallest fraction of the training events a configuration is tried on
+        eta - the fraction grows, and the number of configurations shrinks, by this each rung
+        event_mod - the EventNumber modulus used to split off the testing events
+        every - score each fit after every k-th tree
+        metric - the calc_performance entry to maximize
+        brackets - the number of brackets to run, starting from the one at min_fraction (None for all).
+                   brackets = 1 is plain successive halving of all the configurations.
+        seed - random seed for picking the configurations in each bracket
+        pool - multiprocessing pool to use. If None one is created with processes workers.
+
+    Returns
+        history - DataFrame with one row per trial (Bracket, Rung, Fraction, Events, Params, BestEstimators, metric),
+                  sorted so the best configuration on the largest fraction comes first.
+    '''
+    configs = [dict(default_search_parameters, **c) for c in configs]
+    s_max = int(round(math.log(1.0/min_fraction, eta)))
+    n_brackets = s_max + 1 if brackets is None else min(brackets, s_max + 1)
+    rng = np.random.RandomState(seed)
+
+    log = SearchLog(log_path)
+    fingerprint = data_fingerprint(all_events, training_list)
+    shared = share_training_data(all_events, training_list)
+    own_pool = pool is None
+    history = []
+    try:
+        if own_pool:
+            pool = headless_pool(processes)
+        for bracket, s in enumerate(range(s_max, s_max - n_brackets, -1)):
+            # The first bracket gets all the configurations, the later ones fewer, as they start with more events each.
+            n = len(configs) if bracket == 0 else min(len(configs), int(math.ceil(len(configs)*(s+1)/((s_max+1)*eta**(s_max-s)))))
+            picked = [configs[i] for i in sorted(rng.permutation(len(configs))[:n])]
+            history += successive_halving(shared, fingerprint, log, picked, float(eta)**(-s), eta,
+                                          training_list, event_mod, every, metric, pool, bracket)
+    finally:
+        if own_pool and pool is not None:
+            pool.close()
+            pool.join()
+        shared.cleanup()
+
+    df = pd.DataFrame(history, columns=['Bracket', 'Rung', 'Fraction', 'Events', 'Params', 'BestEstimators', metric])
+    return df.sort_values(['Fraction', metric], ascending=[False, False], kind='mergesort',
+                          key=lambda c: ranking_score(c) if c.name == metric else c).reset_index(drop=True)
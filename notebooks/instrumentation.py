@@ -0,0 +1,223 @@
+#
+# Opt-in timing of the stages of the training and plotting pipelines (loading, prep, fit,
+# predict, performance tables, plotting...). When it is switched off the instrumented
+# functions run as before, with only a flag check added.
+#
+# When it is on, each stage records its wall time, cpu time, the peak memory of the process
+# and the number of rows it worked on. Every process (including pool workers, which inherit
+# the setting) appends its records to its own file in a trace directory, and report()
+# gathers them all up into a json trace, a csv summary, and (optionally) a Chrome trace
+# that can be loaded into chrome://tracing or https://ui.perfetto.dev.
+#
+#   with profiled('scan-profile'):
+#       scan_training_performance(all_events, lists)
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import functools
+import contextlib
+import pandas as pd
+
+# Set in the environment so that worker processes that are started fresh (not forked) record too.
+trace_directory_variable = 'NOTEBOOK_TRACE_DIRECTORY'
+
+_trace_directory = os.environ.get(trace_directory_variable)
+_open_stages = []
+
+def peak_memory_usage():
+    '''Return the peak resident memory of this process in bytes, or None if we can't find out.'''
+    if sys.platform.startswith('linux'):
+        # ru_maxrss of a forked pool worker starts out at the peak of its parent, VmHWM doesn't.
+        try:
+            with open('/proc/self/status') as f:
+                return [int(l.split()[1])*1024 for l in f if l.startswith('VmHWM:')][0]
+        except (IOError, IndexError):
+            pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kB, macOS bytes.
+        return rss if sys.platform == 'darwin' else rss*1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+def is_enabled():
+    return _trace_directory is not None
+
+def enable(directory = None):
+    '''Start recording. Records go to directory (a new temporary directory if None), which is returned.'''
+    global _trace_directory
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='notebook-trace-')
+    elif not os.path.exists(directory):
+        os.makedirs(directory)
+    _trace_directory = directory
+    os.environ[trace_directory_variable] = directory
+    return directory
+
+def disable():
+    '''Stop recording'''
+    global _trace_directory
+    _trace_directory = None
+    os.environ.pop(trace_directory_variable, None)
+
+def count_rows(result):
+    '''Number of rows in a DataFrame, Series or array, or the sum over a tuple or list of them (None if not known).
+    The sum is right for a list of samples, not for a tuple of parallel arrays - see count_first_rows.'''
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result.index)
+    if hasattr(result, 'shape') and len(result.shape) > 0:
+        return result.shape[0]
+    if isinstance(result, (tuple, list)):
+        counts = [count_rows(r) for r in result if isinstance(r, (pd.DataFrame, pd.Series))]
+        return sum(counts) if len(counts) != 0 else None
+    return None
+
+def count_first_rows(result):
+    '''Number of rows in the first of a tuple of results that all have one row per event (e.g. events, classes, weights)'''
+    return count_rows(result[0])
+
+class Stage:
+    '''One timed stage. Set rows inside the with block if it is only known there.'''
+    def __init__(self, name, rows = None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.parent = _open_stages[-1].name if len(_open_stages) != 0 else None
+        _open_stages.append(self)
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.time() - self.start
+        cpu = time.process_time() - self.cpu_start
+        _open_stages.pop()
+        if _trace_directory is not None:
+            record = {'Stage': self.name, 'Parent': self.parent, 'Pid': os.getpid(), 'Start': self.start,
+                      'Wall': wall, 'CPU': cpu, 'PeakRSS': peak_memory_usage(),
+                      'Rows': None if self.rows is None else int(self.rows)}
+            with open(os.path.join(_trace_directory, 'trace-{0}.jsonl'.format(os.getpid())), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return False
+
+class _NoStage:
+    '''Stand-in for Stage when recording is off'''
+    rows = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+def stage(name, rows = None):
+    '''Context manager that times the code inside it as a stage (does nothing if recording is off)'''
+    return Stage(name, rows) if _trace_directory is not None else _NoStage()
+
+def timed(name, rows = count_rows):
+    '''Decorator that times every call of a function as a stage.
+
+    Args
+        name - the stage name
+        rows - function of the return value that gives the number of rows processed (None to not count)
+    '''
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _trace_directory is None:
+                return f(*args, **kwargs)
+            with Stage(name) as s:
+                result = f(*args, **kwargs)
+                if rows is not None:
+                    s.rows = rows(result)
+            return result
+        return wrapper
+    return decorate
+
+def read_trace(directory = None):
+    '''Return all the records written to a trace directory, by every process, as a DataFrame'''
+    directory = _trace_directory if directory is None else directory
+    records = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('trace-') and name.endswith('.jsonl'):
+            with open(os.path.join(directory, name), 'r') as f:
+                records += [json.loads(line) for line in f if len(line.strip()) != 0]
+    columns = ['Stage', 'Parent', 'Pid', 'Start', 'Wall', 'CPU', 'PeakRSS', 'Rows']
+    return pd.DataFrame(records, columns=columns).sort_values('Start', kind='mergesort').reset_index(drop=True)
+
+def summarize(trace):
+    '''Total up a trace by stage. Times of nested stages are included in the stages around them.
+
+    Returns
+        df - DataFrame indexed by stage with the number of calls, total wall and cpu time (seconds),
+             the largest peak memory (MB), total rows, and rows per second of wall time
+    '''
+    g = trace.groupby('Stage', sort=False)
+    df = pd.DataFrame({'Calls': g.size(),
+                       'Wall': g.Wall.sum(),
+                       'CPU': g.CPU.sum(),
+                       'PeakRSS': g.PeakRSS.max()/1024.0/1024.0,
+                       'Processes': g.Pid.nunique(),
+                       'Rows': g.Rows.sum(min_count=1)})
+    df['RowsPerSecond'] = df.Rows/df.Wall
+    return df.sort_values('Wall', ascending=False)
+
+def chrome_trace(trace):
+    '''Convert a trace to the Chrome trace event format (a dict ready for json)'''
+    t0 = trace.Start.min() if len(trace.index) != 0 else 0.0
+    events = [{'name': r.Stage, 'ph': 'X', 'pid': int(r.Pid), 'tid': 0,
+               'ts': (r.Start - t0)*1e6, 'dur': r.Wall*1e6,
+               'args': {'cpu': r.CPU, 'rows': None if pd.isnull(r.Rows) else int(r.Rows)}}
+              for r in trace.itertuples()]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def report(output_prefix, directory = None, chrome = False):
+    '''Write out everything recorded so far.
+
+    Args
+        output_prefix - the files are <output_prefix>-trace.json (every record), <output_prefix>-summary.csv
+                        (see summarize) and, if chrome is True, <output_prefix>-chrome.json
+        directory - the trace directory (None for the one currently recording)
+
+    Returns
+        summary - the summary DataFrame
+    '''
+    trace = read_trace(directory)
+    trace.to_json(output_prefix + '-trace.json', orient='records', indent=1)
+    summary = summarize(trace)
+    summary.to_csv(output_prefix + '-summary.csv', index_label='Stage')
+    if chrome:
+        with open(output_prefix + '-chrome.json', 'w') as f:
+            json.dump(chrome_trace(trace), f)
+    return summary
+
+@contextlib.contextmanager
+def profiled(output_prefix, chrome = False):
+    '''Record everything run inside the with block, and write the report when it is done (see report).
+
+    Pool workers record too if the pool is created inside the block - a pool that was
+    started before doesn't know recording is on. If recording is already on, the block's
+    records just go along with everything else and no report is written here. An
+    output_prefix of None turns this off, so callers can pass an optional prefix straight in.'''
+    if output_prefix is None or is_enabled():
+        yield
+        return
+    directory = enable()
+    try:
+        yield
+    finally:
+        disable()
+        try:
+            report(output_prefix, directory, chrome)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,132 @@
+#
+# An on-disk store of trained BDTs, so re-running a notebook doesn't have to re-fit them.
+# Each model is filed under a hash of everything that went into the fit: the training
+# variables, the estimator parameters, the training data itself, and how the sample
+# was picked (fraction, event_mod split). Models are only read when asked for, and once
+# the store is bigger than its size budget the least recently used ones are removed.
+#
+#   import bdt_training_scikit_tools as tools
+#   tools.model_registry = ModelRegistry('../../TrainedModels')
+#
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump this to ignore all models stored by an older version of the code.
+registry_format_version = 1
+
+def training_data_fingerprint(events, events_weight, events_class):
+    '''Return a hash of the training inputs (feature DataFrame, weights and classes)'''
+    h = hashlib.sha1()
+    h.update(json.dumps([str(c) for c in events.columns]).encode('utf-8'))
+    h.update(np.ascontiguousarray(events.values).tobytes())
+    for a in (events_weight, events_class):
+        h.update(b'None' if a is None else np.ascontiguousarray(np.asarray(a)).tobytes())
+    return h.hexdigest()
+
+def model_key(training_variables, params, fingerprint, fraction = None, event_mod = None):
+    '''Build the key a model is stored under.
+
+    Args
+        training_variables - list of the variables trained on
+        params - dict of the estimator parameters (get_params())
+        fingerprint - hash of the training data (see training_data_fingerprint)
+        fraction - the fraction of events the training sample was cut down to (if any)
+        event_mod - the EventNumber modulus used to split off the testing events (if any)
+    '''
+    k = json.dumps([registry_format_version, list(training_variables), sorted(params.items()), fingerprint, fraction, event_mod], default=repr)
+    return hashlib.sha1(k.encode('utf-8')).hexdigest()
+
+class ModelRegistry:
+    '''A directory of pickled models, one file per key, with an LRU size budget.
+
+    The modification time of a model file is its last use, so several processes can
+    share the same registry without a common index to keep in sync.
+    '''
+    def __init__(self, directory, max_bytes = 10*1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def model_path(self, key):
+        return os.path.join(self.directory, "{0}.pkl".format(key))
+
+    def info_path(self, key):
+        return os.path.join(self.directory, "{0}.json".format(key))
+
+    def __contains__(self, key):
+        return os.path.exists(self.model_path(key))
+
+    def get(self, key):
+        '''Return the model stored under key, or None if there isn't one'''
+        p = self.model_path(key)
+        try:
+            with open(p, 'rb') as f:
+                model = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        os.utime(p)
+        return model
+
+    def info(self, key):
+        '''Return the description that was stored with a model'''
+        with open(self.info_path(key), 'r') as f:
+            return json.load(f)
+
+    def put(self, key, model, info = None):
+        '''Store a model. It is written to a temporary file first and then moved into place,
+        so a reader never sees a partly written model. Older models are then evicted if the
+        registry is over its size budget.'''
+        self._write(self.info_path(key), lambda f: f.write(json.dumps(dict(info if info is not None else {}, Key=key, Stored=time.time()), default=repr).encode('utf-8')))
+        self._write(self.model_path(key), lambda f: pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict(keep=key)
+
+    def _write(self, path, writer):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer(f)
+            os.replace(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def models(self):
+        '''Return a list of (key, size in bytes, last used time) for the stored models'''
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                result.append((name[:-4], st.st_size, st.st_mtime))
+        return result
+
+    def remove(self, key):
+        for p in (self.model_path(key), self.info_path(key)):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep = None):
+        '''Remove the least recently used models until the registry fits in max_bytes.
+
+        Args
+            keep - a key that should never be removed (e.g. the model just stored)
+        '''
+        models = sorted(self.models(), key=lambda m: m[2])
+        total = sum(m[1] for m in models)
+        for key, size, last_used in models:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                self.remove(key)
+                total -= size
@@ -0,0 +1,224 @@
+#
+# Accumulators for the MVA output plots. Each one is filled from a sample in a single pass,
+# can be filled a chunk at a time, and two of them can be added together (e.g. data15 + data16)
+# without ever building the combined DataFrame.
+#
+
+import json
+import numpy as np
+import pandas as pd
+
+class BinnedStatistics:
+    '''Per-bin count, mean and variance of a set of columns, binned along one column (the axis).
+
+    The bins are equal sized and cover [0, 1), the range of the MVA weights. As for a
+    boolean mask ``(v >= low) & (v < high)`` values outside the range, or NaN, are not counted.
+    '''
+    def __init__(self, axis, columns, divisions = 20):
+        self.axis = axis
+        self.columns = list(columns)
+        self.divisions = divisions
+        pdiv = 1.0/divisions
+        self.edges = np.array([b*pdiv for b in range(divisions+1)])
+        self.count = np.zeros(divisions)
+        self.n = np.zeros((len(self.columns), divisions))
+        self.sum = np.zeros((len(self.columns), divisions))
+        self.sumsq = np.zeros((len(self.columns), divisions))
+
+    def bin_index(self, values):
+        '''Return the bin of each value, and a mask of the values that are in a bin'''
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        good = (index >= 0) & (index < self.divisions)
+        return index, good
+
+    def fill_arrays(self, axis_values, column_values):
+        '''Add events to the accumulator.
+
+        Args
+            axis_values - array of the axis column
+            column_values - list of arrays, one for each of the columns
+        '''
+        index, good = self.bin_index(axis_values)
+        index = index[good]
+        count = np.bincount(index, minlength=self.divisions)
+        self.count += count
+        for i, v in enumerate(column_values):
+            v = v[good]
+            ok = ~np.isnan(v)
+            if ok.all():
+                vi = index
+                self.n[i] += count
+            else:
+                vi = index[ok]
+                v = v[ok]
+                self.n[i] += np.bincount(vi, minlength=self.divisions)
+            self.sum[i] += np.bincount(vi, weights=v, minlength=self.divisions)
+            self.sumsq[i] += np.bincount(vi, weights=v*v, minlength=self.divisions)
+        return self
+
+    def fill(self, sample):
+        '''Add all the events in a DataFrame'''
+        return self.fill_arrays(sample[self.axis].values, [sample[c].values.astype(np.float64) for c in self.columns])
+
+    def __add__(self, other):
+        if (other.axis != self.axis) or (other.columns != self.columns) or (other.divisions != self.divisions):
+            raise Exception("Can't add BinnedStatistics along {0} and {1} with different binning or columns".format(self.axis, other.axis))
+        r = BinnedStatistics(self.axis, self.columns, self.divisions)
+        r.count = self.count + other.count
+        r.n = self.n + other.n
+        r.sum = self.sum + other.sum
+        r.sumsq = self.sumsq + other.sumsq
+        return r
+
+    def to_frame(self, variances = False):
+        '''Return the statistics as a DataFrame.
+
+        Args
+            variances - if True add a <column>Variance column for each column (ddof=1, like pandas)
+
+        Returns
+            DataFrame with rows labeled by the lower edge of each bin, the mean of each
+            column, and a SliceCount column with the number of events in each bin.
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum/self.n
+            data = {c: mean[i] for i, c in enumerate(self.columns)}
+            if variances:
+                var = (self.sumsq - self.sum*mean)/(self.n - 1)
+                data.update({'{0}Variance'.format(c): np.where(self.n[i] > 1, var[i], np.nan) for i, c in enumerate(self.columns)})
+        me = pd.DataFrame(data, index=self.edges[:-1], columns=list(data.keys()))
+        me['SliceCount'] = self.count.astype(np.int64)
+        return me
+
+def fill_binned_statistics(sample, axes, divisions = 20, columns = None):
+    '''Build the BinnedStatistics for several axes from one read of a sample.
+
+    Args
+        sample - DataFrame to accumulate
+        axes - list of column names to bin along
+        divisions - number of bins for each axis
+        columns - the columns to average. None means all numeric columns.
+
+    Returns
+        dict of axis name to BinnedStatistics
+    '''
+    if columns is None:
+        columns = [c for c in sample.columns if np.issubdtype(sample[c].dtype, np.number)]
+    values = [sample[c].values.astype(np.float64) for c in columns]
+    return {a: BinnedStatistics(a, columns, divisions).fill_arrays(sample[a].values, values) for a in axes}
+
+def sum_accumulators(accumulators):
+    '''Add up a list of accumulators (e.g. the same histogram for data15 and data16)'''
+    r = accumulators[0]
+    for a in accumulators[1:]:
+        r = r + a
+    return r
+
+class HistogramAccumulator:
+    '''A fixed binning histogram of one or more variables, filled a chunk at a time.
+
+    Keeps the sum of weights and the sum of weights squared in each bin. Follows
+    np.histogram: the bins are [low, high) except for the last one, which includes high.
+    '''
+    def __init__(self, names, nbins = 100, low = 0.0, high = 1.0):
+        self.names = list(names)
+        self.nbins = nbins
+        self.low = low
+        self.high = high
+        self.edges = np.linspace(low, high, nbins+1)
+        self.sumw = np.zeros((len(self.names), nbins))
+        self.sumw2 = np.zeros((len(self.names), nbins))
+
+    def fill_arrays(self, values, weights = None):
+        '''Add events.
+
+        Args
+            values - list of arrays, one for each of the variables
+            weights - array of event weights (None means each event counts as one)
+        '''
+        for i, v in enumerate(values):
+            h_range = (self.low, self.high)
+            self.sumw[i] += np.histogram(v, bins=self.nbins, range=h_range, weights=weights)[0]
+            self.sumw2[i] += np.histogram(v, bins=self.nbins, range=h_range, weights=None if weights is None else weights*weights)[0]
+        return self
+
+    def fill(self, sample, weight = 'Weight'):
+        '''Add all the events in a DataFrame, weighted by the weight column (None for no weight)'''
+        return self.fill_arrays([sample[n].values for n in self.names], None if weight is None else sample[weight].values)
+
+    def __add__(self, other):
+        if (other.names != self.names) or (other.nbins != self.nbins) or (other.low != self.low) or (other.high != self.high):
+            raise Exception("Can't add histograms of {0} and {1} with different binning".format(self.names, other.names))
+        r = HistogramAccumulator(self.names, self.nbins, self.low, self.high)
+        r.sumw = self.sumw + other.sumw
+        r.sumw2 = self.sumw2 + other.sumw2
+        return r
+
+    def density(self, name):
+        '''Return the histogram of a variable normalized to unit area (like np.histogram's density)'''
+        i = self.names.index(name)
+        return self.sumw[i]/(np.sum(self.sumw[i])*np.diff(self.edges))
+
+    def errors(self, name):
+        '''Return the statistical error on each bin of a variable (sqrt of the sum of weights squared)'''
+        return np.sqrt(self.sumw2[self.names.index(name)])
+
+    def to_dict(self):
+        '''Return the histogram as a dict of plain python values (e.g. to write out as json)'''
+        return {'names': self.names, 'nbins': self.nbins, 'low': self.low, 'high': self.high,
+                'sumw': self.sumw.tolist(), 'sumw2': self.sumw2.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        '''Re-create a histogram written out by to_dict'''
+        r = HistogramAccumulator(d['names'], d['nbins'], d['low'], d['high'])
+        r.sumw = np.array(d['sumw'])
+        r.sumw2 = np.array(d['sumw2'])
+        return r
+
+    def save(self, path):
+        '''Write the histogram to a json file'''
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @staticmethod
+    def load(path):
+        '''Read a histogram written by save'''
+        with open(path, 'r') as f:
+            return HistogramAccumulator.from_dict(json.load(f))
+
+# The three MVA weights that are plotted for each sample
+mva_weight_names = ['HSSWeight', 'MultijetWeight', 'BIBWeight']
+
+def mva_histograms(sample, nbins = 100):
+    '''Fill the histograms of the three MVA weights of a sample, weighted by the Weight column'''
+    return HistogramAccumulator(mva_weight_names, nbins).fill(sample)
+
+class RocAccumulator:
+    '''Event counts binned in MVA score, for events below each of a list of bib cuts.
+
+    Filled a chunk at a time, this is what is needed to build the ROC curves
+    for a family of bib cuts without keeping the events in memory. An event passes a
+    bib cut if its bib value is less than the cut. The cuts must be in increasing order.
+    '''
+    def __init__(self, bib_cut_values, nbins = 2000, score = 'HSSWeight', bib = 'BIBWeight'):
+        self.bib_cut_values = np.asarray(bib_cut_values)
+        self.nbins = nbins
+        self.score = score
+        self.bib = bib
+        self.total = 0
+        # Row k holds the events with exactly k of the bib cuts at or below their bib value.
+        self.counts = np.zeros((len(self.bib_cut_values)+1, nbins), dtype=np.int64)
+
+    def fill(self, sample):
+        '''Add all the events in a DataFrame'''
+        s = sample[self.score].values
+        b = np.searchsorted(self.bib_cut_values, sample[self.bib].values, side='right')
+        sbin = np.clip((s*self.nbins).astype(np.int64), 0, self.nbins-1)
+        self.counts += np.bincount(b*self.nbins + sbin, minlength=self.counts.size).reshape(self.counts.shape)
+        self.total += len(s)
+        return self
+
+    def passing(self):
+        '''Return the score histogram of the events passing each bib cut (one row per cut)'''
+        return np.cumsum(self.counts, axis=0)[:-1]
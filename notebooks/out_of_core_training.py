@@ -0,0 +1,418 @@
+#
+# Training on samples that are too big to load into memory. Rather than building the
+# (bib, mj, sig) DataFrame that prep_samples makes, the samples are read from disk a
+# chunk at a time:
+#
+#   1. One pass over the csv files (or the sample cache) writes the training variables,
+#      as float32, to a scratch directory, and keeps a random subset of the events that
+#      the quantile bins of each variable are found from.
+#   2. The scratch copy is converted to bin numbers (one byte per variable per event).
+#   3. The boosting is the same as sklearn's HistGradientBoostingClassifier: a tree per
+#      class per boost, split on the binned values. The gradient histograms for a level of
+#      the trees are added up chunk by chunk, so each level is one pass over the binned events.
+#
+# The chunk size follows from the memory budget, so the memory used depends on the budget
+# and not on the size of the samples. The result has the usual predict, so it can be given
+# to calc_performance, or to streaming_performance if the testing events don't fit in memory either.
+#
+#   bdt = out_of_core_training(default_sample_roots(job), memory_budget=8*1024**3)
+#   streaming_performance(bdt, default_sample_roots(job))
+#
+
+import os
+import shutil
+import tempfile
+from glob import glob
+import numpy as np
+import pandas as pd
+
+from bdt_training_scikit_tools import default_training_variable_list, weighted_confusion_matrix, performance_from_confusion_matrix, \
+    downcast_variant
+from sample_cache import sample_cache_directory, is_cache_valid, read_sample_cache
+from instrumentation import stage
+
+# The number of classes (0 bib, 1 mj, 2 signal), as for prep_samples
+n_classes = 3
+
+def default_sample_roots(job):
+    '''The (bib, mj, sig) samples of a job, as load_default_samples finds them'''
+    return ["../../MVARawData/{0}/{1}".format(job, s) for s in ('bib16', 'multijet', 'signal')]
+
+def _file_chunks(files, columns, chunksize):
+    for f in files:
+        if f.endswith(".p"):
+            df = pd.read_pickle(f)
+            for i in range(0, len(df.index), chunksize):
+                yield df.iloc[i:i+chunksize]
+        else:
+            for chunk in pd.read_csv(f, usecols=columns, chunksize=chunksize):
+                yield chunk
+
+def sample_chunks(name_pattern_root, columns, chunksize, cache_root = None, predicate = None, predicate_columns = ()):
+    '''Read a sample a chunk at a time.
+
+    If the sample has an up to date columnar cache (see sample_cache) the chunks are sliced
+    out of the memory-mapped columns, otherwise the csv files are read chunksize rows at a time.
+    Pickle files can't be read in parts, so each one is loaded whole.
+
+    Args
+        name_pattern_root - path pattern of the sample, as for load_sample
+        columns - the columns to read
+        chunksize - number of rows in each chunk
+        cache_root - where the sample cache is kept (see sample_cache_directory)
+        predicate, predicate_columns - only keep the rows that pass (see load_sample)
+
+    Returns
+        iterator over DataFrames with the columns
+    '''
+    files = glob("{0}*.p".format(name_pattern_root)) + glob("{0}*.csv".format(name_pattern_root))
+    if len(files) == 0:
+        raise Exception("No files found matching {0}".format(name_pattern_root))
+    columns = list(columns)
+    usecols = columns if predicate is None else columns + [c for c in predicate_columns if c not in columns]
+
+    cache_dir = sample_cache_directory(name_pattern_root, cache_root)
+    if is_cache_valid(cache_dir, files) or is_cache_valid(cache_dir, files, downcast_variant):
+        whole = read_sample_cache(cache_dir, usecols)
+        parts = (whole.iloc[i:i+chunksize] for i in range(0, len(whole.index), chunksize))
+    else:
+        parts = _file_chunks(files, usecols, chunksize)
+
+    for chunk in parts:
+        if predicate is not None:
+            chunk = chunk[np.asarray(predicate(chunk))]
+        yield chunk.loc[:, columns]
+
+def chunk_rows_for_budget(memory_budget, n_features, reserved = 0):
+    '''The number of events to work on at a time to stay inside a memory budget.
+
+    Args
+        memory_budget - bytes we can use
+        n_features - number of training variables
+        reserved - bytes that are used no matter the chunk size (bin samples, histograms)
+    '''
+    # Roughly what one event costs while a chunk is read and while its histograms are filled.
+    per_row = 48*n_features + 512
+    rows = (memory_budget - reserved) // per_row
+    if rows < 1000:
+        raise Exception("A memory budget of {0:.0f} MB is too small (at least {1:.0f} MB is needed)".format(
+            memory_budget/1024.0/1024.0, (reserved + 1000*per_row)/1024.0/1024.0))
+    return int(rows)
+
+def quantile_thresholds(values, max_bins = 255):
+    '''Find the bin boundaries for a variable from a sample of its values.
+
+    If there are no more than max_bins different values, each gets its own bin (the boundaries
+    are half way between them). Otherwise the boundaries are at max_bins-1 evenly spaced quantiles.
+    A value v goes in bin searchsorted(thresholds, v, side='right'); NaN goes in the last bin.
+    '''
+    v = values[~np.isnan(values)]
+    if len(v) == 0:
+        return np.zeros(0)
+    u = np.unique(v)
+    if len(u) <= max_bins:
+        return (u[:-1] + u[1:])/2.0
+    return np.unique(np.quantile(v, np.linspace(0.0, 1.0, max_bins+1)[1:-1]))
+
+def bin_features(features, thresholds):
+    '''Convert a float matrix (one column per variable) to bin numbers (uint8, one column per variable)'''
+    binned = np.empty(features.shape, dtype=np.uint8)
+    for j, t in enumerate(thresholds):
+        binned[:,j] = np.searchsorted(t, features[:,j], side='right')
+    return binned
+
+class _Spill:
+    '''Fixed width row-major arrays in files in a scratch directory, read and written by row ranges'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.widths = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def append(self, name, array):
+        array = np.ascontiguousarray(array)
+        self.widths[name] = (array.dtype, 1 if array.ndim == 1 else array.shape[1])
+        with open(self.path(name), 'ab') as f:
+            array.tofile(f)
+
+    def read(self, name, start, count):
+        dtype, width = self.widths[name]
+        with open(self.path(name), 'rb') as f:
+            f.seek(start*width*dtype.itemsize)
+            a = np.fromfile(f, dtype=dtype, count=count*width)
+        return a if width == 1 else a.reshape(count, width)
+
+    def write(self, name, start, array):
+        dtype, width = self.widths[name]
+        with open(self.path(name), 'r+b') as f:
+            f.seek(start*width*dtype.itemsize)
+            np.ascontiguousarray(array, dtype=dtype).tofile(f)
+
+    def remove(self, name):
+        os.remove(self.path(name))
+        del self.widths[name]
+
+class OutOfCoreBDT:
+    '''The boosted trees from out_of_core_training.
+
+    Every tree is a full binary tree of max_depth levels. An event goes to the right at an
+    internal node if its bin number for the node's variable is above the node's threshold bin.
+    A node that wasn't worth splitting sends everything left (threshold bin 255).
+
+    Args
+        training_variables - the variables, in the order of the feature columns
+        thresholds - the bin boundaries of each variable (see quantile_thresholds)
+        init - the starting raw score of each class
+        feature, threshold_bin - (boosts, classes, 2**max_depth-1) arrays of the internal nodes
+        value - (boosts, classes, 2**max_depth) array of leaf values (learning rate included)
+    '''
+    def __init__(self, training_variables, thresholds, init, max_depth, feature, threshold_bin, value):
+        self.training_variables = list(training_variables)
+        self.thresholds = [np.asarray(t) for t in thresholds]
+        self.init = np.asarray(init, dtype=np.float64)
+        self.max_depth = max_depth
+        self.feature = feature
+        self.threshold_bin = threshold_bin
+        self.value = value
+        self.classes_ = np.arange(n_classes)
+
+    @property
+    def n_estimators(self):
+        return self.value.shape[0]
+
+    def bin(self, events):
+        '''Convert events (a DataFrame with the training variables, or a matrix in their order) to bin numbers'''
+        if isinstance(events, pd.DataFrame):
+            events = events[self.training_variables].values
+        return bin_features(np.asarray(events), self.thresholds)
+
+    def decision_function(self, events, n_stages = None, block_size = 1000000):
+        '''The raw score of each class for each event, using the first n_stages boosts (all if None)'''
+        binned = self.bin(events)
+        n_stages = self.n_estimators if n_stages is None else n_stages
+        raw = np.empty((len(binned), n_classes))
+        for start in range(0, len(binned), block_size):
+            b = binned[start:start+block_size]
+            r = np.tile(self.init, (len(b), 1))
+            for t in range(n_stages):
+                for k in range(n_classes):
+                    r[:,k] += self.value[t,k][leaf_index(b, self.feature[t,k], self.threshold_bin[t,k], self.max_depth)]
+            raw[start:start+block_size] = r
+        return raw
+
+    def predict_proba(self, events):
+        return softmax(self.decision_function(events))
+
+    def predict(self, events):
+        return self.classes_[np.argmax(self.decision_function(events), axis=1)]
+
+def softmax(raw):
+    e = np.exp(raw - np.max(raw, axis=1)[:,None])
+    return e/np.sum(e, axis=1)[:,None]
+
+def leaf_index(binned, feature, threshold_bin, depth):
+    '''Walk binned events down depth levels of a tree. Returns the index of the node each one ends
+    up in, counted from the first node of that level.'''
+    node = np.zeros(len(binned), dtype=np.intp)
+    rows = np.arange(len(binned))
+    for level in range(depth):
+        node = 2*node + 1 + (binned[rows, feature[node]] > threshold_bin[node])
+    return node - (2**depth - 1)
+
+def best_splits(G, H, C, l2_regularization, min_samples_leaf, min_hessian):
+    '''Find the best split of each node from its gradient histograms.
+
+    Args
+        G, H, C - (nodes, variables, bins) sums of gradient, hessian and event count
+
+    Returns
+        split - bool array, True if the node should be split
+        feature, threshold_bin - the split of each node
+        left, right - (nodes, 2) arrays of the (gradient, hessian) sums on each side. For a node
+                      that isn't split, everything is on the left.
+    '''
+    nodes, nf, nb = G.shape
+    GL, HL, CL = [np.cumsum(a, axis=2)[:,:,:-1] for a in (G, H, C)]
+    Gt, Ht, Ct = [np.sum(a[:,0,:], axis=1)[:,None,None] for a in (G, H, C)]
+    GR, HR, CR = Gt - GL, Ht - HL, Ct - CL
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gain = GL*GL/(HL + l2_regularization) + GR*GR/(HR + l2_regularization) - Gt*Gt/(Ht + l2_regularization)
+    gain[(CL < min_samples_leaf) | (CR < min_samples_leaf) | (HL < min_hessian) | (HR < min_hessian) | ~np.isfinite(gain)] = -np.inf
+
+    flat = gain.reshape(nodes, -1)
+    best = np.argmax(flat, axis=1)
+    rows = np.arange(nodes)
+    split = flat[rows, best] > 1e-12
+    feature, threshold_bin = best // (nb - 1), best % (nb - 1)
+    left = np.where(split[:,None], np.stack([GL[rows, feature, threshold_bin], HL[rows, feature, threshold_bin]], axis=1), np.stack([Gt[:,0,0], Ht[:,0,0]], axis=1))
+    right = np.where(split[:,None], np.stack([GR[rows, feature, threshold_bin], HR[rows, feature, threshold_bin]], axis=1), 0.0)
+    return split, np.where(split, feature, 0), np.where(split, threshold_bin, 255), left, right
+
+def out_of_core_training(sample_roots, training_variable_list = default_training_variable_list, estimators = 400, learning_rate = 0.1,
+                         max_depth = 3, max_bins = 255, min_samples_leaf = 20, l2_regularization = 0.0, min_hessian = 1e-3,
+                         event_mod = 3, memory_budget = 2*1024**3, max_bin_samples = 1000000, work_dir = None,
+                         cache_root = None, signal_predicate = None, seed = 0, verbose = False):
+    '''Train a BDT on samples read from disk a chunk at a time, with memory bounded by a budget.
+
+    Args
+        sample_roots - the (bib, mj, sig) sample path patterns (see default_sample_roots, load_sample)
+        training_variable_list - variables to train on
+        estimators - number of boosts
+        learning_rate, max_depth, max_bins, min_samples_leaf, l2_regularization - as for HistGradientBoostingClassifier
+        min_hessian - smallest sum of hessians allowed on each side of a split
+        event_mod - train on events with EventNumber % event_mod != 0, as test_train_samples does.
+                    None trains on everything.
+        memory_budget - bytes the chunks, bin samples and histograms may use
+        max_bin_samples - number of events the quantile bins are found from
+        work_dir - where the binned events are kept while training (a temporary directory, removed
+                   afterwards, if None). It needs about (variables + 33) bytes per event.
+        cache_root - where the sample caches are kept (see sample_chunks)
+        signal_predicate - (predicate, predicate columns) to cut the signal sample as it is read (e.g. trim_predicate())
+        seed - random seed for picking the bin samples
+        verbose - print progress
+
+    Returns
+        bdt - OutOfCoreBDT
+    '''
+    if len(sample_roots) != n_classes:
+        raise Exception("Need {0} samples (bib, mj, sig), got {1}".format(n_classes, len(sample_roots)))
+    if max_bins > 255:
+        raise Exception("max_bins can be at most 255, not {0}".format(max_bins))
+    nf = len(training_variable_list)
+    nb = 256
+    leaves = 2**max_depth
+    reserved = 3*max_bin_samples*(nf + 1)*8 + 6*n_classes*(leaves//2)*nf*nb*8
+    chunksize = chunk_rows_for_budget(memory_budget, nf, reserved)
+    rng = np.random.RandomState(seed)
+
+    own_dir = work_dir is None
+    work_dir = tempfile.mkdtemp(prefix='out-of-core-') if own_dir else work_dir
+    spill = _Spill(work_dir)
+    try:
+        # Pass 1: copy the training events to the scratch directory, keeping a random subset for the bins.
+        keys = np.zeros(0)
+        picked = np.zeros((0, nf), dtype=np.float32)
+        n = 0
+        class_weight = np.zeros(n_classes)
+        columns = list(training_variable_list) + ['EventNumber', 'Weight']
+        with stage('out_of_core_read') as s:
+            for cls, root in enumerate(sample_roots):
+                predicate, predicate_columns = signal_predicate if (signal_predicate is not None and cls == 2) else (None, None)
+                for chunk in sample_chunks(root, columns, chunksize, cache_root, predicate, predicate_columns):
+                    if event_mod is not None:
+                        chunk = chunk[chunk.EventNumber.values % event_mod != 0]
+                    if len(chunk.index) == 0:
+                        continue
+                    features = chunk[training_variable_list].values.astype(np.float32)
+                    weight = chunk.Weight.values.astype(np.float64)
+                    spill.append('features', features)
+                    spill.append('weight', weight)
+                    spill.append('class', np.full(len(weight), cls, dtype=np.int8))
+                    class_weight[cls] += np.sum(weight)
+                    n += len(weight)
+
+                    keys = np.concatenate([keys, rng.uniform(size=len(weight))])
+                    picked = np.concatenate([picked, features])
+                    if len(keys) > max_bin_samples:
+                        keep = np.argpartition(keys, max_bin_samples)[:max_bin_samples]
+                        keys, picked = keys[keep], picked[keep]
+            s.rows = n
+        if n == 0:
+            raise Exception("No training events found in {0}".format(sample_roots))
+        if verbose:
+            print ("Read {0} training events, {1} at a time".format(n, chunksize))
+
+        # Pass 2: bin the events, and set every event's raw scores to the starting value.
+        thresholds = [quantile_thresholds(picked[:,j].astype(np.float64), max_bins) for j in range(nf)]
+        del keys, picked
+        with np.errstate(divide='ignore'):
+            init = np.log(class_weight/np.sum(class_weight))
+        init = np.where(np.isfinite(init), init, -50.0)
+        with stage('out_of_core_bin', rows=n):
+            for start in range(0, n, chunksize):
+                count = min(chunksize, n - start)
+                spill.append('binned', bin_features(spill.read('features', start, count), thresholds))
+                spill.append('raw', np.tile(init, (count, 1)))
+            spill.remove('features')
+
+        # Boost: each level of the trees is one pass over the binned events.
+        internal = leaves - 1
+        feature = np.zeros((estimators, n_classes, internal), dtype=np.intp)
+        threshold_bin = np.full((estimators, n_classes, internal), 255, dtype=np.intp)
+        value = np.zeros((estimators, n_classes, leaves))
+        offsets = np.arange(nf)
+        with stage('out_of_core_boost', rows=n):
+            for t in range(estimators):
+                for level in range(max_depth):
+                    nodes = 2**level
+                    G = np.zeros((n_classes, nodes*nf*nb))
+                    H = np.zeros((n_classes, nodes*nf*nb))
+                    C = np.zeros((n_classes, nodes*nf*nb))
+                    for start in range(0, n, chunksize):
+                        count = min(chunksize, n - start)
+                        binned = spill.read('binned', start, count)
+                        raw = spill.read('raw', start, count)
+                        if level == 0 and t > 0:
+                            for k in range(n_classes):
+                                raw[:,k] += value[t-1,k][leaf_index(binned, feature[t-1,k], threshold_bin[t-1,k], max_depth)]
+                            spill.write('raw', start, raw)
+                        p = softmax(raw)
+                        w = spill.read('weight', start, count)
+                        cls = spill.read('class', start, count)
+                        y = np.zeros_like(p)
+                        y[np.arange(count), cls] = 1.0
+                        g = w[:,None]*(p - y)
+                        h = w[:,None]*p*(1.0 - p)
+                        for k in range(n_classes):
+                            node = leaf_index(binned, feature[t,k], threshold_bin[t,k], level)
+                            index = ((node[:,None]*nf + offsets)*nb + binned).ravel()
+                            G[k] += np.bincount(index, weights=np.repeat(g[:,k], nf), minlength=G.shape[1])
+                            H[k] += np.bincount(index, weights=np.repeat(h[:,k], nf), minlength=H.shape[1])
+                            C[k] += np.bincount(index, minlength=C.shape[1])
+
+                    first = nodes - 1
+                    for k in range(n_classes):
+                        split, f, b, left, right = best_splits(G[k].reshape(nodes, nf, nb), H[k].reshape(nodes, nf, nb), C[k].reshape(nodes, nf, nb),
+                                                               l2_regularization, min_samples_leaf, min_hessian)
+                        feature[t,k,first:first+nodes] = f
+                        threshold_bin[t,k,first:first+nodes] = b
+                        if level == max_depth - 1:
+                            with np.errstate(invalid='ignore', divide='ignore'):
+                                sums = np.stack([left, right], axis=1).reshape(leaves, 2)
+                                value[t,k] = np.where(sums[:,1] + l2_regularization > 0, -learning_rate*sums[:,0]/(sums[:,1] + l2_regularization), 0.0)
+                if verbose and (t+1) % 50 == 0:
+                    print ("  boost {0} of {1}".format(t+1, estimators))
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return OutOfCoreBDT(training_variable_list, thresholds, init, max_depth, feature, threshold_bin, value)
+
+def streaming_performance(bdt, sample_roots, training_variables = None, event_mod = 3, chunksize = 1000000, cache_root = None, signal_predicate = None):
+    '''The calc_performance table for the testing events (EventNumber % event_mod == 0), read a chunk at a time.
+
+    Args
+        bdt - a trained BDT with predict (e.g. from out_of_core_training or default_training)
+        sample_roots - the (bib, mj, sig) sample path patterns
+        training_variables - the variables the BDT was trained on (None to take them from an OutOfCoreBDT)
+        chunksize, cache_root, signal_predicate - as for out_of_core_training
+
+    Returns
+        d - dict as returned by calc_performance
+    '''
+    training_variables = bdt.training_variables if training_variables is None else training_variables
+    columns = list(training_variables) + ['EventNumber', 'WeightMCEvent', 'WeightXSection']
+    m = np.zeros((n_classes, n_classes))
+    counts = np.zeros(n_classes, dtype=np.int64)
+    for cls, root in enumerate(sample_roots):
+        predicate, predicate_columns = signal_predicate if (signal_predicate is not None and cls == 2) else (None, None)
+        for chunk in sample_chunks(root, columns, chunksize, cache_root, predicate, predicate_columns):
+            chunk = chunk[chunk.EventNumber.values % event_mod == 0]
+            if len(chunk.index) == 0:
+                continue
+            classes = np.full(len(chunk.index), cls)
+            weights = chunk.WeightMCEvent.values.astype(np.float64)*chunk.WeightXSection.values
+            m += weighted_confusion_matrix(classes, bdt.predict(chunk[training_variables]), weights)
+            counts[cls] += len(classes)
+    return performance_from_confusion_matrix(m, counts)
@@ -0,0 +1,201 @@
+#
+# Re-weighting of the training samples as a function of JetPt (or JetET), done in python
+# rather than when the samples are dumped. This is the same thing FlattenBySpectra and
+# ReweightToFlat in CalRatioTMVAUtilities/PtReweightUtils.cs do: histogram the variable
+# with the event weights, and scale each event's weight by a factor for its bin. The new
+# weight is written to Weight (so prep_samples picks it up) and the factor to WeightFlatten.
+#
+# The spectra of each job's samples are kept in a small cache file, so trying another
+# reweighting scheme on the same job doesn't have to histogram the samples again.
+#
+#   all_events = load_default_samples(job)
+#   all_events = reweight_samples(all_events, 'flatten', job=job)
+#   events, events_class, training_weight, evaluation_weight = prep_samples(*all_events)
+#
+
+import os
+import json
+import numpy as np
+
+from instrumentation import timed
+
+# The binning of JetPtPlotRaw (libDataAccess/PlotSpecifications.cs): (number of bins, low, high) in GeV
+pt_binning = (150, 0.0, 750.0)
+
+# The variables the samples can be flattened in (TrainingSpectraFlatteningPossibilities)
+flattening_variables = ['JetPt', 'JetET']
+
+# The reweighting schemes reweight_samples knows about
+reweighting_schemes = ['none', 'flatten', 'match']
+
+def bin_edges(binning):
+    nbins, low, high = binning
+    return np.linspace(low, high, nbins+1)
+
+def bin_index(values, binning):
+    '''Return the bin of each value, with ROOT's numbering: 0 is underflow, 1 to nbins the
+    bins, and nbins+1 overflow (values at the upper edge, and NaN, go in the overflow).'''
+    return np.searchsorted(bin_edges(binning), values, side='right')
+
+def base_weight(sample, weight = 'Weight'):
+    '''The event weights before any flattening. If the sample was dumped already flattened
+    the factor that was used is in WeightFlatten, and is divided back out.'''
+    w = sample[weight].values.astype(np.float64)
+    if 'WeightFlatten' not in sample.columns:
+        return w
+    f = sample['WeightFlatten'].values.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(f != 0, w/f, w)
+
+def spectrum(sample, variable = 'JetPt', binning = pt_binning, weight = 'Weight'):
+    '''Histogram a variable with the (un-flattened) event weights.
+
+    Returns
+        h - array of nbins+2 sums of weights, including the underflow and overflow bins (see bin_index)
+    '''
+    return np.bincount(bin_index(sample[variable].values, binning), weights=base_weight(sample, weight), minlength=binning[0]+2)
+
+class SpectrumReweighting:
+    '''A weight factor for each bin of a variable, that can be applied to a sample'''
+    def __init__(self, variable, binning, factors):
+        self.variable = variable
+        self.binning = tuple(binning)
+        self.factors = np.asarray(factors, dtype=np.float64)
+
+    def weights(self, sample):
+        '''Return the factor for each event of a sample'''
+        return self.factors[bin_index(sample[self.variable].values, self.binning)]
+
+    def apply(self, sample, weight = 'Weight'):
+        '''Return the sample with Weight set to factor * (un-flattened) Weight, and WeightFlatten set to the factor.
+        The other columns are shared with the sample passed in, not copied.'''
+        w = self.weights(sample)
+        df = sample.copy(deep=False)
+        df[weight] = w*base_weight(sample, weight)
+        df['WeightFlatten'] = w
+        return df
+
+    def to_dict(self):
+        return {'variable': self.variable, 'binning': list(self.binning), 'factors': self.factors.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        return SpectrumReweighting(d['variable'], d['binning'], d['factors'])
+
+def flatten_reweighting(h, variable = 'JetPt', binning = pt_binning, normalization = 1.0):
+    '''The factors that make a spectrum flat: normalization over the contents of each bin (0 for an empty bin).
+
+    Unlike ReweightToFlat, which leaves the overflow bin out of the loop (so events there are
+    scaled by the bin's sum of weights), the overflow is flattened like every other bin.
+    '''
+    with np.errstate(divide='ignore'):
+        return SpectrumReweighting(variable, binning, np.where(h != 0, normalization/h, 0.0))
+
+def match_reweighting(h, target, variable = 'JetPt', binning = pt_binning):
+    '''The factors that make a spectrum the same shape as the target spectrum, normalized to its
+    own total weight. Events in bins where the target is empty get weight 0, and target bins the
+    spectrum has no events in are left empty.'''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return SpectrumReweighting(variable, binning, np.where(h != 0, (target/np.sum(target))/(h/np.sum(h)), 0.0))
+
+def flatten_by_spectra(sample, variable = 'JetPt', binning = pt_binning, normalization = 1.0):
+    '''Flatten one sample in variable (FlattenBySpectra). Returns the re-weighted sample.'''
+    if variable not in flattening_variables:
+        raise Exception("Can't flatten by '{0}' (known: {1})".format(variable, flattening_variables))
+    return flatten_reweighting(spectrum(sample, variable, binning), variable, binning, normalization).apply(sample)
+
+class SpectraCache:
+    '''The spectra of each job's samples, kept in a json file.
+
+    A spectrum is only re-used if the sample still has the same number of events and
+    sum of weights, so a re-dumped job is histogrammed again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.spectra = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.spectra = json.load(f)
+
+    def key(self, job, sample_index, variable, binning):
+        return json.dumps([job, sample_index, variable, list(binning)])
+
+    def get(self, key, events, total_weight):
+        s = self.spectra.get(key)
+        if s is None or s['Events'] != events or not np.isclose(s['TotalWeight'], total_weight, rtol=1e-9, atol=0):
+            return None
+        return np.array(s['Spectrum'])
+
+    def put(self, key, events, total_weight, h):
+        self.spectra[key] = {'Events': events, 'TotalWeight': total_weight, 'Spectrum': h.tolist()}
+        if self.path is not None:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.spectra, f)
+            os.replace(tmp, self.path)
+
+def default_cache_path(job):
+    '''Where the spectra of a job are cached: next to its samples (see load_default_samples)'''
+    return "../../MVARawData/{0}/.pt_reweight_cache.json".format(job)
+
+def sample_spectra(all_events, variable = 'JetPt', binning = pt_binning, job = None, cache_path = None):
+    '''Return the spectrum of each of the (bib, mj, sig) samples, from the cache if we have them.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        job - the job the samples are from. None means don't cache.
+        cache_path - the cache file (default_cache_path(job) if None)
+    '''
+    cache = SpectraCache(None if job is None else (default_cache_path(job) if cache_path is None else cache_path))
+    spectra = []
+    for i, s in enumerate(all_events):
+        key = cache.key(job, i, variable, binning)
+        events = len(s.index)
+        total_weight = float(np.sum(base_weight(s)))
+        h = cache.get(key, events, total_weight)
+        if h is None:
+            h = spectrum(s, variable, binning)
+            cache.put(key, events, total_weight, h)
+        spectra.append(h)
+    return spectra
+
+def sample_reweightings(spectra, scheme = 'flatten', variable = 'JetPt', binning = pt_binning, target = 2):
+    '''Build the reweighting of each sample from their spectra.
+
+    Args
+        spectra - list of the spectrum of each sample (see sample_spectra)
+        scheme - 'none' (leave the weights alone), 'flatten' (flatten each sample, as the
+                 sample dumping does), or 'match' (give each sample the shape of the target sample)
+        target - index of the sample the others are matched to (2 is signal)
+
+    Returns
+        list with a SpectrumReweighting for each sample (None for 'none')
+    '''
+    if scheme not in reweighting_schemes:
+        raise Exception("Unknown reweighting scheme '{0}' (known: {1})".format(scheme, reweighting_schemes))
+    if scheme == 'none':
+        return [None for h in spectra]
+    if scheme == 'flatten':
+        return [flatten_reweighting(h, variable, binning) for h in spectra]
+    return [match_reweighting(h, spectra[target], variable, binning) for h in spectra]
+
+@timed('reweight_samples')
+def reweight_samples(all_events, scheme = 'flatten', variable = 'JetPt', binning = pt_binning, target = 2, job = None, cache_path = None):
+    '''Reweight the (bib, mj, sig) samples before prep_samples.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        scheme - see sample_reweightings
+        variable - the variable to reweight in (JetPt or JetET)
+        binning - (number of bins, low, high) of the variable
+        target - for 'match', the sample the others are matched to
+        job, cache_path - where to cache the spectra (see sample_spectra)
+
+    Returns
+        the tripple of samples, with new Weight and WeightFlatten columns
+    '''
+    if variable not in flattening_variables:
+        raise Exception("Can't reweight by '{0}' (known: {1})".format(variable, flattening_variables))
+    spectra = sample_spectra(all_events, variable, binning, job, cache_path)
+    reweightings = sample_reweightings(spectra, scheme, variable, binning, target)
+    return tuple(s if r is None else r.apply(s) for s, r in zip(all_events, reweightings))
@@ -0,0 +1,185 @@
+#
+# A columnar, on-disk cache for the raw samples written out by a training job.
+# Each sample (bib16, multijet, signal, ...) is converted once into one .npy file per column.
+# The cache is re-built whenever one of the source files changes (size or modification time),
+# and is read back memory-mapped, so only the columns that are actually used get paged in.
+#
+# A rebuild never touches the files of the cache it replaces: the new columns go to new files
+# and the manifest is swapped in last. A process that still has the old columns mapped keeps
+# reading the old (unchanged) data.
+#
+
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Bump this if the on-disk layout changes - old caches will then be ignored and rebuilt.
+cache_format_version = 1
+
+manifest_name = 'manifest.json'
+
+def source_signature(files):
+    '''Build the signature of a list of source files that is used to invalidate the cache.
+
+    Args
+        files - list of paths to the source files
+
+    Returns
+        sig - list of [name, size, mtime] for each file, sorted by name
+    '''
+    sig = []
+    for f in sorted(files):
+        st = os.stat(f)
+        sig.append([os.path.basename(f), st.st_size, st.st_mtime])
+    return sig
+
+def sample_cache_directory(name_pattern_root, cache_root = None):
+    '''Return the directory where a sample's cache lives.
+
+    Args
+        name_pattern_root - the path pattern used to find the sample (e.g. ../../MVARawData/1234/bib16)
+        cache_root - directory where all caches are kept. Defaults to a .sample_cache directory
+                     next to the source files.
+    '''
+    directory, stem = os.path.split(name_pattern_root)
+    if cache_root is None:
+        cache_root = os.path.join(directory, '.sample_cache')
+    return os.path.join(cache_root, stem)
+
+def read_manifest(cache_dir):
+    '''Return the manifest for the cache, or None if there isn't a complete one there'''
+    p = os.path.join(cache_dir, manifest_name)
+    if not os.path.exists(p):
+        return None
+    with open(p, 'r') as f:
+        return json.load(f)
+
+def is_cache_valid(cache_dir, files, variant = None):
+    '''Check to see if the cache is up to date with the source files.
+
+    Args
+        cache_dir - the cache directory for this sample
+        files - the source files the cache should have been built from
+        variant - extra information about how the cache was built (must match exactly)
+    '''
+    m = read_manifest(cache_dir)
+    if m is None:
+        return False
+    return m['version'] == cache_format_version \
+        and m['variant'] == variant \
+        and m['sources'] == source_signature(files)
+
+def write_sample_cache(cache_dir, df, files, variant = None):
+    '''Write a DataFrame out as a set of column files.
+
+    Each column goes to a new, uniquely named file, and the manifest is replaced last (atomically),
+    so a cache that was interrupted while being written is never treated as valid, and readers of
+    the previous cache are never handed half written data. The previous cache's column files are
+    then removed (a reader that has them mapped keeps its copy until it lets go).
+
+    Args
+        cache_dir - the cache directory for this sample
+        df - the DataFrame to cache
+        files - the source files the DataFrame was built from
+        variant - extra information about how the cache was built
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    mpath = os.path.join(cache_dir, manifest_name)
+
+    columns = []
+    for index, c in enumerate(df.columns):
+        values = df[c].values
+        pickled = values.dtype == object
+        fd, p = tempfile.mkstemp(dir = cache_dir, prefix = 'col{0}-'.format(index), suffix = '.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, values, allow_pickle = pickled)
+        columns.append({'name': c, 'file': os.path.basename(p), 'pickled': pickled})
+
+    manifest = {'version': cache_format_version,
+                'variant': variant,
+                'sources': source_signature(files),
+                'rows': len(df.index),
+                'columns': columns}
+    fd, tmp = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, mpath)
+
+    # Clean up the column files of earlier builds.
+    keep = set(c['file'] for c in columns)
+    for name in os.listdir(cache_dir):
+        if name.startswith('col') and name.endswith('.npy') and name not in keep:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+def read_sample_cache(cache_dir, columns = None, mmap = True, predicate = None, predicate_columns = ()):
+    '''Read back a cached sample.
+
+    Args
+        cache_dir - the cache directory for this sample
+        columns - list of columns to load. None means all of them.
+        mmap - if True the numeric columns are memory-mapped read-only rather than read into memory.
+        predicate - function that takes a DataFrame and returns a mask of the rows to keep. It sees the
+                    columns and the predicate_columns, memory-mapped, so only the columns it looks at are
+                    read to evaluate it, and only the rows that pass are copied into memory.
+        predicate_columns - the columns the predicate needs that aren't in columns
+
+    Returns
+        df - DataFrame with the requested columns
+    '''
+    try:
+        return _read_sample_cache(cache_dir, columns, mmap, predicate, predicate_columns)
+    except FileNotFoundError:
+        # The cache was rebuilt between reading the manifest and opening a column: read the new one.
+        return _read_sample_cache(cache_dir, columns, mmap, predicate, predicate_columns)
+
+def _read_sample_cache(cache_dir, columns, mmap, predicate, predicate_columns):
+    m = read_manifest(cache_dir)
+    if m is None:
+        raise Exception("No sample cache found in {0}".format(cache_dir))
+    by_name = {c['name']: c for c in m['columns']}
+    names = [c['name'] for c in m['columns']] if columns is None else list(columns)
+    missing = [n for n in names if n not in by_name]
+    if len(missing) != 0:
+        raise KeyError("Columns {0} are not in the cached sample {1}".format(missing, cache_dir))
+
+    def load(n):
+        c = by_name[n]
+        p = os.path.join(cache_dir, c['file'])
+        if c['pickled']:
+            return np.load(p, allow_pickle = True)
+        return np.load(p, mmap_mode = 'r' if mmap else None)
+
+    if predicate is None:
+        return pd.DataFrame({n: load(n) for n in names}, columns = names, copy = False)
+
+    predicate_names = names + [n for n in predicate_columns if n not in names]
+    rows = np.flatnonzero(np.asarray(predicate(pd.DataFrame({n: load(n) for n in predicate_names}, copy = False))))
+    return pd.DataFrame({n: load(n)[rows] for n in names}, columns = names, copy = False)
+
+def load_cached_sample(name_pattern_root, files, reader, columns = None, cache_root = None, variant = None,
+                       predicate = None, predicate_columns = ()):
+    '''Load a sample from the cache, building the cache first if it is missing or out of date.
+
+    Args
+        name_pattern_root - the path pattern used to find the sample
+        files - the source files that make up the sample
+        reader - function that reads the source files into a single DataFrame. Only
+                 called if the cache has to be rebuilt.
+        columns - list of columns to load. None means all of them.
+        cache_root - directory where all caches are kept (see sample_cache_directory)
+        variant - extra information about how the cached DataFrame was built
+        predicate, predicate_columns - only keep the rows that pass (see read_sample_cache)
+
+    Returns
+        df - the sample DataFrame, memory-mapped from the cache (or, with a predicate, just the rows that pass)
+    '''
+    cache_dir = sample_cache_directory(name_pattern_root, cache_root)
+    if not is_cache_valid(cache_dir, files, variant):
+        write_sample_cache(cache_dir, reader(), files, variant)
+    return read_sample_cache(cache_dir, columns, predicate = predicate, predicate_columns = predicate_columns)
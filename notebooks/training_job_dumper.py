@@ -5,52 +5,76 @@
 
 # Configure the environment
 import os
+import json
+import hashlib
+import argparse
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-plt.rc('font', size=14) # Font size for titles and axes, default is 10
-from mpl_toolkits.mplot3d import Axes3D # if this isn't done then the 3d projection isn't known. Aweful UI!
-from sklearn.metrics import roc_curve, auc
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from mva_accumulators import fill_binned_statistics, BinnedStatistics, HistogramAccumulator, RocAccumulator, \
+    mva_histograms, mva_weight_names, sum_accumulators
+from instrumentation import profiled, stage, timed
+
+# matplotlib (and sklearn) are only loaded when something is drawn (or a ROC curve calculated), so
+# importing this module to crunch numbers, or in a worker process, is quick.
+_pyplot_configured = False
+def pyplot():
+    '''Return matplotlib.pyplot, setting it up the first time it is asked for'''
+    global _pyplot_configured
+    import matplotlib.pyplot as plt
+    if not _pyplot_configured:
+        plt.rc('font', size=14) # Font size for titles and axes, default is 10
+        from mpl_toolkits.mplot3d import Axes3D # if this isn't done then the 3d projection isn't known. Aweful UI!
+        _pyplot_configured = True
+    return plt
+
+# The columns of the all-<sample>.csv files the plots use
+mva_columns = ['Weight', 'HSSWeight', 'MultijetWeight', 'BIBWeight']
 
 # Load mva data from csv files
-def load_mva_data(data_location, sample_name):
+@timed('load_mva_data')
+def load_mva_data(data_location, sample_name, columns = None, chunksize = None):
     """Load the data written out by a MVA training job into an np array.
     Returns null if the csv file can't be found.
     
     Args:
       sample_name: The name of the sample, e.g. data15
+      columns: Only read these columns (as float64). None means read everything.
+      chunksize: If not None, return an iterator over DataFrames of this many rows
+                 rather than reading the whole file at once.
     """
-    p = "{0}\\all-{1}.csv".format(data_location, sample_name)
+    p = os.path.join(data_location, "all-{0}.csv".format(sample_name))
     if not os.path.exists(p):
         return None
-    return pd.read_csv(p)
+    if columns is None:
+        return pd.read_csv(p, chunksize=chunksize)
+    return pd.read_csv(p, usecols=columns, dtype={c: np.float64 for c in columns}, chunksize=chunksize)
 
 # Load data for a list of samples
-def load_mva_data_from_list(location, lst):
+def load_mva_data_from_list(location, lst, columns = None):
     """Load data for a series of samples. Silently ignore those we can't find
     
     Args:
         lst: List of samples to load
+        columns: Only read these columns. None means read everything.
     """
-    return {s[0] : s[1] for s in [(sname, load_mva_data(location, sname)) for sname in lst] if not(s[1] is None)}
+    return {s[0] : s[1] for s in [(sname, load_mva_data(location, sname, columns)) for sname in lst] if not(s[1] is None)}
 
 # Plot a particular mva sample's response for training
 def plot_mva_sample(sample_name, sample_data):
     """Plot the HSS, BIB, and MJ all on one plot as a histogram
     
     Args:
-      sample_data: The DataFrame that contains the data for this sample
+      sample_data: HistogramAccumulator of the MVA weights for this sample (see mva_histograms).
+                   A DataFrame that contains the data for this sample is also accepted.
     """
-    nbins = 100
+    plt = pyplot()
+    hists = mva_histograms(sample_data) if isinstance(sample_data, pd.DataFrame) else sample_data
     fig = plt.figure(figsize=(15,8))
     ax = fig.add_subplot(111)
-    plt.hist([sample_data['HSSWeight'], sample_data['MultijetWeight'], sample_data['BIBWeight']],
-             weights=[sample_data.Weight, sample_data.Weight, sample_data.Weight],
-             bins=nbins,
-             histtype = 'step', normed=True,
-             color=['red', 'blue', 'green'],
-             label=['HSS Weight', 'Multijet Weight', 'BIB Weight'])
+    for name, color, label in zip(mva_weight_names, ['red', 'blue', 'green'], ['HSS Weight', 'Multijet Weight', 'BIB Weight']):
+        plt.hist(hists.edges[:-1], bins=hists.edges, weights=hists.density(name), histtype='step', color=color, label=label)
     plt.title("BDT Weights for Sample {0}".format(sample_name))
     plt.xlabel('MVA Weight')
     plt.legend()
@@ -58,6 +82,7 @@ def plot_mva_sample(sample_name, sample_data):
 
 # Plot a list of samples mva response.
 def plot_mva_samples(dict_of_samples):
+    plt = pyplot()
     for k in dict_of_samples.keys():
         plot_mva_sample(k, dict_of_samples[k])
         plt.show()
@@ -79,6 +104,7 @@ def roc_curve_calc(signal, background, weight='HSSWeight'):
     # build a single array marking one as signal and the other as background
     truth = np.concatenate((np.ones(len(signal.index)), np.zeros(len(background.index))))
     score = np.concatenate((signal[weight], background[weight]))
+    from sklearn.metrics import roc_curve, auc
     (fpr, tpr, thresholds) = roc_curve(truth,score)
     
     a = auc(fpr, tpr)
@@ -96,6 +122,7 @@ def plot_roc_curve (tpr, fpr, aroc, signal_name = 'Signal', background_name = 'J
         signal_name - for the signal axis label
         background_name - for the background axis name
     '''
+    plt = pyplot()
     plt.figure(figsize=(10,10))
     plt.plot(fpr, tpr, color='darkorange', label='ROC Curve area {0:0.2f}'.format(aroc))
     plt.xlim([0.0,1.0])
@@ -133,23 +160,136 @@ def calc_roc_with_bib_cut (sig, back, bib, bib_cut = 0.5):
     
     return (tpr, fpr, aroc, sig_eff, back_eff, bib_eff)
 
+# Calc the ROC curves for a whole list of bib cuts, sorting the events only once
+def roc_curves_for_bib_cuts (sig, back, bib_cut_values, weight='HSSWeight'):
+    '''Calc the ROC curves for signal vs background after each of a list of bib cuts.
+    The events are sorted by weight once, and each bib cut is then a mask and a cumulative sum.
+    Gives the same curves as calc_roc_with_bib_cut (and sklearn's roc_curve).
+
+    Args:
+        sig - signal DataFrame
+        back - background DataFrame
+        bib_cut_values - list of bib cuts. Only events with a bib value less than the cut are used.
+        weight - the column in the DataFrame that we pull the weights from
+
+    Returns:
+        list of (tpr, fpr, aroc, sig_eff, back_eff) for each bib cut
+    '''
+    # Same order roc_curve uses: descending score, stable.
+    truth = np.concatenate((np.ones(len(sig.index)), np.zeros(len(back.index))))
+    score = np.concatenate((sig[weight].values, back[weight].values))
+    bib_value = np.concatenate((sig['BIBWeight'].values, back['BIBWeight'].values))
+    order = np.argsort(score, kind="mergesort")[::-1]
+    truth = truth[order]
+    score = score[order]
+    bib_value = bib_value[order]
+
+    result = []
+    for bib_cut in bib_cut_values:
+        keep = bib_value < bib_cut
+        t = truth[keep]
+        sc = score[keep]
+        n_sig = np.sum(t)
+        sig_eff = n_sig/len(sig.index)
+        back_eff = (len(t)-n_sig)/len(back.index)
+
+        # The cumulative counts at the last event of each distinct score
+        threshold_idxs = np.r_[np.where(np.diff(sc))[0], len(sc)-1]
+        tps = np.cumsum(t)[threshold_idxs]
+        fps = 1 + threshold_idxs - tps
+
+        result.append(roc_from_cumulative_counts(tps, fps) + (sig_eff, back_eff))
+    return result
+
+# Turn cumulative counts into a ROC curve
+def roc_from_cumulative_counts(tps, fps):
+    '''Build a ROC curve from the number of signal and background events above each threshold,
+    in decreasing threshold order. As roc_curve does, colinear points are dropped and (0, 0) is added.
+
+    Returns:
+        tpr - true positive rate
+        fpr - false positive rate
+        aroc - area under the ROC curve
+    '''
+    if len(fps) > 2:
+        optimal_idxs = np.where(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])[0]
+        fps = fps[optimal_idxs]
+        tps = tps[optimal_idxs]
+    tpr = np.r_[0, tps]/tps[-1]
+    fpr = np.r_[0, fps]/fps[-1]
+    from sklearn.metrics import auc
+    return (tpr, fpr, auc(fpr, tpr))
+
+# Calc the ROC family from binned counts
+def roc_curves_from_accumulators (sig, back):
+    '''Calc the ROC curves for each bib cut from RocAccumulators filled with the signal and background.
+    The thresholds are the score bin edges, so this is a binned version of roc_curves_for_bib_cuts.
+
+    Args:
+        sig - RocAccumulator for the signal
+        back - RocAccumulator for the background, with the same bib cuts and binning
+
+    Returns:
+        list of (tpr, fpr, aroc, sig_eff, back_eff) for each bib cut
+    '''
+    result = []
+    for s_hist, b_hist in zip(sig.passing(), back.passing()):
+        # Walk down from the highest score bin, keeping only bins with events in them
+        s_hist = s_hist[::-1]
+        b_hist = b_hist[::-1]
+        filled = (s_hist + b_hist) > 0
+        tps = np.cumsum(s_hist)[filled]
+        fps = np.cumsum(b_hist)[filled]
+        result.append(roc_from_cumulative_counts(tps, fps) + (np.sum(s_hist)/sig.total, np.sum(b_hist)/back.total))
+    return result
+
+# Find the bib cuts once for a job
+@timed('bib_cuts_for_samples', rows=None)
+def bib_cuts_for_samples (bib_samples, bib_cut_range = np.logspace(-3,0,30)):
+    '''Find the bib cut values that keep each fraction of the bib events, and the fraction
+    of bib events below each cut. Only the BIBWeight column of the bib samples is used, so
+    several bib samples (e.g. data15 and data16) can be passed without combining the DataFrames.
+    The cut is the bib value of the event at that fraction of the sorted events.
+
+    Args:
+        bib_samples - a bib DataFrame, or a list of them that are treated as one sample
+        bib_cut_range - the bib efficiencies to look at
+
+    Returns:
+        bib_cut_values - array of cuts
+        bib_eff - array of the fraction of bib events with a value less than each cut
+    '''
+    if isinstance(bib_samples, pd.DataFrame):
+        bib_samples = [bib_samples]
+    values = np.concatenate([b['BIBWeight'].values for b in bib_samples])
+    index = np.array([int((len(values)-1)*cut_fraction) for cut_fraction in bib_cut_range])
+    bib_cut_values = np.partition(values, np.unique(index))[index]
+
+    # Count the events below each cut with one pass over the values.
+    sorted_cuts = np.sort(bib_cut_values)
+    below = np.cumsum(np.bincount(np.searchsorted(sorted_cuts, values, side='right'), minlength=len(sorted_cuts)+1))
+    bib_eff = below[np.searchsorted(sorted_cuts, bib_cut_values, side='left')]/len(values)
+    return (bib_cut_values, bib_eff)
+
 # Generate a family of ROC curves
-def calc_roc_family (sig, back, bib, bib_cut_range = np.logspace(-3,0,30)):
+@timed('calc_roc_family', rows=None)
+def calc_roc_family (sig, back, bib, bib_cut_range = np.logspace(-3,0,30), bib_cuts = None):
     '''Calc ROC Curve for a family of bib cuts
     
     Args:
         sig - signal DataFrame
         back - background (jz) DataFrame
-        bib - bib DataFrame
+        bib - bib DataFrame (or list of them, see bib_cuts_for_samples)
         bib_cut_range - Value of bib efficiencies to look at. Actual cuts are determined from this
+        bib_cuts - the (bib_cut_values, bib_eff) from bib_cuts_for_samples. Pass these when running
+                   over several signal samples so the bib sample is only looked at once. If given,
+                   bib and bib_cut_range are ignored.
 
     Returns:
         all - DataFrame of truth and false postive rate, area under curve, sig, back, and bib eff, and the bib cut
     '''
-    sorted_bib_values = bib['BIBWeight'].sort_values()
-    lst_len = len(sorted_bib_values.index)-1
-    bib_cut_values = [sorted_bib_values.values[index] for index in [int(lst_len*cut_fraction) for cut_fraction in bib_cut_range]]
-    all = [calc_roc_with_bib_cut (sig, back, bib, bib_cut = bc)+(bc,) for bc in bib_cut_values]
+    bib_cut_values, bib_eff = bib_cuts if bib_cuts is not None else bib_cuts_for_samples(bib, bib_cut_range)
+    all = [r + (be, bc) for r, be, bc in zip(roc_curves_for_bib_cuts(sig, back, bib_cut_values), bib_eff, bib_cut_values)]
     return pd.DataFrame(all, columns=['tpr', 'fpr', 'aroc', 'sig_eff', 'back_eff', 'bib_eff', 'bib_cut'])
 
 # Plot the efficiency for a single BIB sample
@@ -160,6 +300,7 @@ def plot_eff_for_bib(ps, sample_name):
         ps - DataFrame of the sample we will look at
         sample_name - Name of sample
     '''
+    plt = pyplot()
     fig = plt.figure(figsize=(10,10))
     ax = fig.add_subplot(111)
     plt.plot(ps.bib_eff,ps.sig_eff, label='Sample {0}'.format(sample_name))
@@ -181,6 +322,7 @@ def plot_all_eff_for_bib(samples):
     Args
         samples - The df containing all singal samples ROC calculations with eff loaded
     '''
+    plt = pyplot()
     fig = plt.figure(figsize=(15,10))
     ax = fig.add_subplot(111)
     # Do the eff samples
@@ -213,6 +355,7 @@ def plot_roc_family_sample(sample_info_bib, sample_name, background_name = 'JZ',
         None
         But matplotlib will be sitting at a plot
     '''
+    plt = pyplot()
     resample = 1
     if nsamples <= len(sample_info_bib.index):
         resample = int(len(sample_info_bib.index)/nsamples)
@@ -242,16 +385,34 @@ def split_data_in_slices (sample, weight, divisions = 20):
         DataFrame with rows labeled by the lower edge of the sliced bin, and average
         weight for HSS, MultiJet, and BIB, and a column with the # of events in each bin.
     '''
-    s = sample.drop('Weight', axis=1)
-    pdiv = 1.0/divisions
-    slice_edges = [(b*pdiv, pdiv*(b+1)) for b in range(divisions)]
+    return split_data_in_slices_for_axes(sample, [weight], divisions)[weight]
 
-    mean_evolution = {se[0]:s[(s[weight] >= se[0]) & (s[weight] < se[1])].mean() for se in slice_edges}
-    count = {se[0]:len(s[(s[weight] >= se[0]) & (s[weight] < se[1])].index) for se in slice_edges}
+# Slice a sample along several weights at once
+def split_data_in_slices_for_axes (sample, weights, divisions = 20, variances = False):
+    '''Split a sample up along several axes, reading the data only once. See split_data_in_slices.
 
-    me = pd.DataFrame(mean_evolution).T
-    me['SliceCount']=pd.Series(list(count.values()), index=me.index)
-    return me
+    Args:
+        sample - The sample DataFrame we are going to split
+        weights - List of weight axes to split by
+        divisions - How many equal sized bins to split this into
+        variances - Also include the variance of each column in each bin
+
+    Returns:
+        Dict of weight axis to the slice DataFrame
+    '''
+    stats = slice_statistics_for_axes(sample, weights, divisions)
+    return {w: stats[w].to_frame(variances) for w in weights}
+
+# The accumulated slice statistics, before they are turned into a DataFrame
+def slice_statistics_for_axes (sample, weights, divisions = 20):
+    '''Fill the BinnedStatistics behind split_data_in_slices_for_axes. These can be added
+    together to get the slices of a combined sample.
+
+    Returns:
+        Dict of weight axis to BinnedStatistics
+    '''
+    columns = [c for c in sample.columns if c != 'Weight' and np.issubdtype(sample[c].dtype, np.number)]
+    return fill_binned_statistics(sample, weights, divisions, columns)
 
 # Split all the slices
 def split_data_in_slices_for_all (samples, weight, divisions = 20):
@@ -267,6 +428,21 @@ def split_data_in_slices_for_all (samples, weight, divisions = 20):
     '''
     return {name:split_data_in_slices(samples[name],weight,divisions) for name in samples}
 
+# Split all the slices along all the weights
+def split_data_in_slices_for_all_axes (samples, weights, divisions = 20):
+    '''Split all the samples in the dict samples along each of the weights, reading each sample once
+
+    Args
+        samples - dict of all samples
+        weights - list of weight axes to split along
+        divisions - how many equal bins to split things into
+
+    Return
+        Dict of weight name to a dict of sample name to results
+    '''
+    by_sample = {name:split_data_in_slices_for_axes(samples[name], weights, divisions) for name in samples}
+    return {w:{name:by_sample[name][w] for name in samples} for w in weights}
+
 # Plot the # of events in each slice
 def plot_average_weights (sample, sample_name, slice_weight_name):
     '''Plot the slice data for a particular sample
@@ -279,6 +455,7 @@ def plot_average_weights (sample, sample_name, slice_weight_name):
     Returns
         Plot drawn on the current figure.
     '''
+    plt = pyplot()
     fig = plt.figure(figsize=(10,10))
     ax = fig.add_subplot(111)
     ax.plot(sample.index, sample['HSSWeight'], label='HSS Weight')
@@ -301,6 +478,7 @@ def plot_slice_sizes (sample, sample_name, slice_weight_name):
     Returns
         Default plot of the number of events
     '''
+    plt = pyplot()
     fig = plt.figure(figsize=(15,10))
     ax = fig.add_subplot(111)
     ax.plot(sample.index, sample.SliceCount)
@@ -308,80 +486,380 @@ def plot_slice_sizes (sample, sample_name, slice_weight_name):
     ax.set_ylabel('Number of Events in Bin')
     ax.set_title('Events in each slice of {0} in {1}'.format(slice_weight_name, sample_name))
 
-# Call this to dump out plotting information in the location of jobdir.
-def training_job (jobdir, outputdir, jobindex):
-    '''Dump all plots for a particular job.
+# Set up a process to render plots
+def init_render_worker():
+    '''Plot rendering workers never show anything, so use the non-interactive Agg backend'''
+    import matplotlib
+    matplotlib.use('Agg')
+
+# Render a single plot to a file
+def render_plot(plot_job):
+    '''Draw a plot and save it.
+
+    Args:
+        plot_job - tuple of (plot function, arguments to the plot function, filename)
+
+    Returns:
+        filename - the file that was written
+    '''
+    plt = pyplot()
+    plot_function, plot_args, filename = plot_job
+    with stage('render_plot'):
+        plot_function(*plot_args)
+        plt.savefig(filename)
+        plt.close()
+    return filename
+
+# Render a list of plots, in parallel if possible
+def render_plots(plot_jobs, workers = None):
+    '''Render all the plots. Each plot is independent, so they are sent out to
+    a pool of processes.
+
+    Args:
+        plot_jobs - list of (plot function, arguments to the plot function, filename)
+        workers - number of processes to use. None means one per core, 1 renders
+                  everything in this process.
+
+    Returns:
+        list of files written, in the same order as plot_jobs
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(plot_jobs) <= 1:
+        return [render_plot(pj) for pj in plot_jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(plot_jobs)), initializer=init_render_worker) as executor:
+        return list(executor.map(render_plot, plot_jobs))
+
+# The samples a training job writes out
+signal_sample_names=["125pi25lt5m", "200pi25lt5m", "400pi50lt5m", "600pi150lt5m", "1000pi400lt5m"]
+bib_sample_names=["data15", "data16"]
+mj_sample_names=["jz"]
+slice_weight_names=['MultijetWeight', 'HSSWeight']
+
+# Calculate everything the plots need, with all the data in memory
+@timed('job_plot_data', rows=None)
+def job_plot_data (jobdir):
+    '''Load a job's samples and calculate what goes into the plots.
 
     Args:
         jobdir - location in the filesystem where the job csv files have been unpacked
-        outputdir - location where the plots and python outputs should be written
-        jobindex - the job number - used as part of the job filenames.
 
+    Returns:
+        mva_plots - dict of sample name to the HistogramAccumulator of its MVA weights
+        all_slices - dict of weight name to dict of sample name to slice DataFrame
+        p_samples - dict of signal sample name to its ROC family DataFrame
     '''
-    signal_sample_names=["125pi25lt5m", "200pi25lt5m", "400pi50lt5m", "600pi150lt5m", "1000pi400lt5m"]
-    bib_sample_names=["data15", "data16"]
-    mj_sample_names=["jz"]
+    signal_samples = load_mva_data_from_list(jobdir, signal_sample_names, mva_columns)
+    bib_samples = load_mva_data_from_list(jobdir, bib_sample_names, mva_columns)
+    mj_samples = load_mva_data_from_list(jobdir, mj_sample_names, mva_columns)
 
-    signal_samples = load_mva_data_from_list(jobdir, signal_sample_names)
-    bib_samples = load_mva_data_from_list(jobdir, bib_sample_names)
-    mj_samples = load_mva_data_from_list(jobdir, mj_sample_names)
+    if len(bib_samples) == 0:
+        raise Exception("No BIB samples were found. Needed to complete plots!")
+
+    # Histogram and slice each sample once. The plots only need these.
+    all_samples = {**signal_samples, **bib_samples, **mj_samples}
+    mva_hists = {k:mva_histograms(all_samples[k]) for k in all_samples}
+    slice_stats = {k:slice_statistics_for_axes(all_samples[k], slice_weight_names) for k in all_samples}
 
     # If we have more than one BIB sample, combine them.
+    bib_samples_list = list(bib_samples)
+    if len(bib_samples) > 1:
+        mva_hists["BIBAll"] = sum_accumulators([mva_hists[k] for k in bib_samples_list])
+        slice_stats["BIBAll"] = {w:sum_accumulators([slice_stats[k][w] for k in bib_samples_list]) for w in slice_weight_names}
+
+    # See how the MVA's evolve as a function of the Jet and signal numbers
+    all_slices = {w:{k:slice_stats[k][w].to_frame() for k in slice_stats} for w in slice_weight_names}
+
+    # Get ROC info for all samples. The bib cuts are the same for all of them.
+    bib_cuts = bib_cuts_for_samples([bib_samples[k] for k in bib_samples_list])
+    p_samples = {sname:calc_roc_family(signal_samples[sname], mj_samples["jz"], None, bib_cuts=bib_cuts) for sname in signal_samples.keys()}
+
+    return (mva_hists, all_slices, p_samples)
+
+# Find the bib cuts from a histogram of the bib values
+def bib_cuts_from_histogram (bib_hist, bib_cut_range = np.logspace(-3,0,30)):
+    '''Find the bib cut values (and bib efficiencies) from a finely binned histogram of the
+    BIBWeight of the bib sample. This is the binned version of what calc_roc_family does with
+    the sorted bib values: the cut is the lower edge of the bin that holds the event at each fraction.
+
+    Args:
+        bib_hist - HistogramAccumulator of BIBWeight, filled without weights
+        bib_cut_range - the bib efficiencies to look at
+
+    Returns:
+        bib_cut_values - array of cuts
+        bib_eff - array of the fraction of bib events below each cut
+    '''
+    counts = bib_hist.sumw[0]
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    k = np.searchsorted(cum, [int((n-1)*f) for f in bib_cut_range], side='right')
+    return (bib_hist.edges[k], (cum[k]-counts[k])/n)
+
+# Calculate everything the plots need, reading the data a chunk at a time
+@timed('streaming_job_plot_data', rows=None)
+def streaming_job_plot_data (jobdir, chunksize, bib_cut_range = np.logspace(-3,0,30), nbins = 100, divisions = 20, bib_quantile_bins = 100000):
+    '''Calculate what goes into the plots, reading each csv file in chunks so the memory used
+    doesn't depend on the size of the samples. Only the Weight and MVA weight columns are read.
+    The ROC curves are built from the score binned in 2000 bins, and the bib cuts from the
+    bib score binned in bib_quantile_bins bins, so they are a close approximation to job_plot_data.
+
+    Args:
+        jobdir - location in the filesystem where the job csv files have been unpacked
+        chunksize - the number of rows to read at a time
+
+    Returns:
+        Same as job_plot_data.
+    '''
+    def accumulate(sname, extra, fill_extra = lambda e, chunk: e.fill(chunk)):
+        chunks = load_mva_data(jobdir, sname, mva_columns, chunksize)
+        if chunks is None:
+            return None
+        hist = HistogramAccumulator(mva_weight_names, nbins)
+        slices = {w:BinnedStatistics(w, mva_weight_names, divisions) for w in slice_weight_names}
+        for chunk in chunks:
+            hist.fill(chunk)
+            for w in slices:
+                slices[w].fill(chunk)
+            for e in extra:
+                fill_extra(e, chunk)
+        return (hist, slices, extra)
+
+    # The bib samples come first, as the ROC curves need the bib cuts. The bib cuts are quantiles
+    # of the bib events (as in bib_cuts_for_samples), so that histogram counts events, not weights.
+    bib_samples = {k:v for k, v in [(sname, accumulate(sname, [HistogramAccumulator(['BIBWeight'], bib_quantile_bins)],
+                                                       lambda e, chunk: e.fill(chunk, weight=None)))
+                                    for sname in bib_sample_names] if v is not None}
     if len(bib_samples) == 0:
-        raise "No BIB samples were found. Needed to complete plots!"
+        raise Exception("No BIB samples were found. Needed to complete plots!")
     bib_samples_list = list(bib_samples)
     bib_key = bib_samples_list[0]
     if len(bib_samples) > 1:
-        r = bib_samples[bib_key]
-        for k in [nk for nk in bib_samples_list if nk != bib_key]:
-            r = r.append(bib_samples[k])
-        bib_samples["BIBAll"] = r
+        bib_samples["BIBAll"] = (sum_accumulators([bib_samples[k][0] for k in bib_samples_list]),
+                                 {w:sum_accumulators([bib_samples[k][1][w] for k in bib_samples_list]) for w in slice_weight_names},
+                                 [sum_accumulators([bib_samples[k][2][0] for k in bib_samples_list])])
         bib_key = "BIBAll"
+    bib_cut_values, bib_eff = bib_cuts_from_histogram(bib_samples[bib_key][2][0], bib_cut_range)
 
-    # Plot the raw MVA values for the samples
+    signal_samples = {k:v for k, v in [(sname, accumulate(sname, [RocAccumulator(bib_cut_values)])) for sname in signal_sample_names] if v is not None}
+    mj_samples = {k:v for k, v in [(sname, accumulate(sname, [RocAccumulator(bib_cut_values)])) for sname in mj_sample_names] if v is not None}
     all_samples = {**signal_samples, **bib_samples, **mj_samples}
-    for k in all_samples:
-        plot_mva_sample(k, all_samples[k])
-        plt.savefig("{0}/{1}-mva-{2}.png".format(outputdir, jobindex, k))
-        plt.close()
 
-    # See how the MVA's evolve as a function of the Jet and signal numbers
-    all_slices = {sname:split_data_in_slices_for_all(all_samples, sname) for sname in ['MultijetWeight', 'HSSWeight']}
+    all_slices = {w:{k:all_samples[k][1][w].to_frame() for k in all_samples} for w in slice_weight_names}
+    p_samples = {sname:pd.DataFrame([r + (be, bc) for r, be, bc in zip(roc_curves_from_accumulators(signal_samples[sname][2][0], mj_samples["jz"][2][0]), bib_eff, bib_cut_values)],
+                                    columns=['tpr', 'fpr', 'aroc', 'sig_eff', 'back_eff', 'bib_eff', 'bib_cut'])
+                 for sname in signal_samples}
+    mva_plots = {k:all_samples[k][0] for k in all_samples}
+    return (mva_plots, all_slices, p_samples)
+
+# Call this to dump out plotting information in the location of jobdir.
+def training_job (jobdir, outputdir, jobindex, workers = None, chunksize = None, profile = False):
+    '''Dump all plots for a particular job.
+
+    Args:
+        jobdir - location in the filesystem where the job csv files have been unpacked
+        outputdir - location where the plots and python outputs should be written
+        jobindex - the job number - used as part of the job filenames.
+        workers - number of processes used to render the plots (None means one per core)
+        chunksize - if not None, read the csv files this many rows at a time (see streaming_job_plot_data),
+                    for samples that are too big to fit in memory.
+        profile - if True, time each stage (loading, histograms, ROC curves, rendering in each worker)
+                  and write the report next to the plots as <jobindex>-profile-* (see instrumentation.report)
+
+    Returns:
+        list of the plot files written
+    '''
+    with profiled(profile_prefix(outputdir, jobindex) if profile else None, chrome=True):
+        return _training_job(jobdir, outputdir, jobindex, workers, chunksize)
+
+# Where the profile report of a job is written
+def profile_prefix(outputdir, jobindex):
+    return os.path.join(outputdir, "{0}-profile".format(jobindex))
+
+def _training_job (jobdir, outputdir, jobindex, workers, chunksize):
+    # First calculate everything that goes into the plots.
+    if chunksize is None:
+        mva_plots, all_slices, p_samples = job_plot_data(jobdir)
+    else:
+        mva_plots, all_slices, p_samples = streaming_job_plot_data(jobdir, chunksize)
+
+    # Next, the list of plots to make.
+    plot_jobs = []
+
+    # Plot the raw MVA values for the samples
+    for k in mva_plots:
+        plot_jobs.append((plot_mva_sample, (k, mva_plots[k]), "{0}/{1}-mva-{2}.png".format(outputdir, jobindex, k)))
 
     for wt in all_slices:
         for s in all_slices[wt]:
-            plot_average_weights(all_slices[wt][s], s, wt)
-            plt.savefig("{0}/{1}-slice-{2}-{3}.png".format(outputdir, jobindex, s, wt))
-            plt.close()
-            plot_slice_sizes(all_slices[wt][s], s, wt)
-            plt.savefig("{0}/{1}-slicesize-{2}-{3}.png".format(outputdir, jobindex, s, wt))
-            plt.close()
-
-    # Get ROC info for all samples, and plot them
-    p_samples = {sname:calc_roc_family(signal_samples[sname], mj_samples["jz"], bib_samples[bib_key]) for sname in signal_samples.keys()}
+            plot_jobs.append((plot_average_weights, (all_slices[wt][s], s, wt), "{0}/{1}-slice-{2}-{3}.png".format(outputdir, jobindex, s, wt)))
+            plot_jobs.append((plot_slice_sizes, (all_slices[wt][s], s, wt), "{0}/{1}-slicesize-{2}-{3}.png".format(outputdir, jobindex, s, wt)))
+
     for sname in p_samples.keys():
-        plot_roc_family_sample(p_samples[sname], sname)
-        plt.savefig("{0}/{1}-roc-{2}.png".format(outputdir, jobindex, sname))
-        plt.close()
+        plot_jobs.append((plot_roc_family_sample, (p_samples[sname], sname), "{0}/{1}-roc-{2}.png".format(outputdir, jobindex, sname)))
 
     # Plot the efficiencies for all these samples on a single plot
-    plot_all_eff_for_bib(p_samples)
-    plt.savefig("{0}/{1}-eff.png".format(outputdir, jobindex))
-    plt.close()
+    plot_jobs.append((plot_all_eff_for_bib, (p_samples,), "{0}/{1}-eff.png".format(outputdir, jobindex)))
+
+    return render_plots(plot_jobs, workers)
+
+
+# Hash a file's contents
+def file_hash(path):
+    '''Return the sha1 of a file's contents'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Version of the code that makes the plots
+def code_version():
+    '''Hash of the source of the modules that make the plots. If any of it changes, all jobs are re-done'''
+    import mva_accumulators
+    h = hashlib.sha1()
+    for m in (__file__, mva_accumulators.__file__):
+        with open(m, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# Where the record of the last run for a job is kept
+def manifest_path(outputdir, jobindex):
+    return os.path.join(outputdir, "{0}-manifest.json".format(jobindex))
+
+# Build the record of the inputs for a job
+def job_inputs(jobdir, previous = None):
+    '''Return the size, modification time and hash of each input csv file for a job.
+
+    Args:
+        jobdir - location of the job csv files
+        previous - the inputs recorded last time. If a file's size and modification time
+                   haven't changed its hash is taken from here rather than re-calculated.
+
+    Returns:
+        dict of file name to dict with size, mtime, and sha1
+    '''
+    previous = {} if previous is None else previous
+    inputs = {}
+    for name in sorted(f for f in os.listdir(jobdir) if f.startswith('all-') and f.endswith('.csv')):
+        st = os.stat(os.path.join(jobdir, name))
+        old = previous.get(name)
+        if old is not None and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+            sha1 = old['sha1']
+        else:
+            sha1 = file_hash(os.path.join(jobdir, name))
+        inputs[name] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1}
+    return inputs
+
+# The options of a run that change the plots (workers and profile only change how they are made)
+def job_options(chunksize = None):
+    return {'chunksize': chunksize}
+
+# Check to see if the plots for a job need to be re-made
+def job_is_up_to_date(jobdir, outputdir, jobindex, version = None, options = None):
+    '''True if the last run of this job used the same inputs, code and options (see job_options),
+    and all its plots are still there'''
+    p = manifest_path(outputdir, jobindex)
+    if not os.path.exists(p):
+        return False
+    with open(p, 'r') as f:
+        manifest = json.load(f)
+    if manifest['code'] != (code_version() if version is None else version):
+        return False
+    if manifest.get('options') != (job_options() if options is None else options):
+        return False
+    if {k: v['sha1'] for k, v in job_inputs(jobdir, manifest['inputs']).items()} != {k: v['sha1'] for k, v in manifest['inputs'].items()}:
+        return False
+    return all(os.path.exists(f) for f in manifest['outputs'])
+
+# Dump a job and record what was done
+def dump_training_job (jobdir, outputdir, jobindex, workers = None, chunksize = None, profile = False):
+    '''Run training_job, and write a manifest of the inputs, code version, options and outputs next to the plots'''
+    inputs = job_inputs(jobdir)
+    outputs = training_job(jobdir, outputdir, jobindex, workers, chunksize, profile)
+    manifest = {'code': code_version(), 'inputs': inputs, 'options': job_options(chunksize), 'outputs': outputs}
+    tmp = manifest_path(outputdir, jobindex) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path(outputdir, jobindex))
+    return outputs
+
+def _dump_batch_job(job):
+    jobdir, outputdir, jobindex, workers, chunksize, profile = job
+    dump_training_job(jobdir, outputdir, jobindex, workers=workers, chunksize=chunksize, profile=profile)
+    return jobindex
+
+# Dump many jobs
+def batch_training_jobs (jobdirs, outputdir, processes = None, force = False, chunksize = None, profile = False, workers = None):
+    '''Dump the plots for many jobs in one go. Jobs whose inputs, code and options haven't changed
+    since the last time are skipped. The job number is the name of the job directory.
 
+    Args:
+        jobdirs - list of job directories
+        outputdir - location where all the plots should be written
+        processes - number of jobs to run at once (None means one per core)
+        force - re-make the plots for every job
+        chunksize - read the csv files this many rows at a time (see training_job)
+        profile - write a profile report for each job that is run (see training_job)
+        workers - number of processes used to render the plots of each job. None means one per core
+                  if there is only one job to run, and one each if several jobs are run at once.
+
+    Returns:
+        dict of job number to 'skipped' or 'done'
+    '''
+    version = code_version()
+    options = job_options(chunksize)
+    jobs = [(jobdir, outputdir, os.path.basename(os.path.normpath(jobdir))) for jobdir in jobdirs]
+    status = {j[2]: 'skipped' for j in jobs if not force and job_is_up_to_date(j[0], j[1], j[2], version, options)}
+    todo = [j for j in jobs if j[2] not in status]
+    if len(todo) == 1:
+        # A single job gets the whole machine for its plots.
+        status[_dump_batch_job(todo[0] + (workers, chunksize, profile))] = 'done'
+    elif len(todo) != 0:
+        todo = [j + (1 if workers is None else workers, chunksize, profile) for j in todo]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for jobindex in executor.map(_dump_batch_job, todo):
+                status[jobindex] = 'done'
+    return status
 
 # If invoked from main
 def main(args):
-    jobdir = args[1]
-    outputdir = args[2]
-    jobindex = args[3]
+    parser = argparse.ArgumentParser(description='Dump the plots for a training job. With --batch, dump them for many jobs, skipping those that have not changed.')
+    parser.add_argument('directories', nargs='+',
+                        help='jobdir outputdir jobindex, or with --batch, outputdir jobdir [jobdir ...] (the directory name is the job number)')
+    parser.add_argument('--batch', action='store_true', help='Dump many jobs in one go')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes used to make the plots of a job (with --batch, the default is one per job if several are run)')
+    parser.add_argument('--processes', type=int, default=None, help='With --batch, the number of jobs to run at once')
+    parser.add_argument('--force', action='store_true', help='With --batch, re-make the plots even if nothing has changed')
+    parser.add_argument('--chunksize', type=int, default=None, help='Read the csv files this many rows at a time')
+    parser.add_argument('--profile', action='store_true', help='Write a report of the time spent in each stage next to the plots')
+    a = parser.parse_args(args[1:])
+
+    if a.batch:
+        outputdir, jobdirs = a.directories[0], a.directories[1:]
+        if len(jobdirs) == 0:
+            parser.error('--batch needs an output directory and at least one job directory')
+    else:
+        if len(a.directories) != 3:
+            parser.error('expected jobdir outputdir jobindex')
+        if a.processes is not None or a.force:
+            parser.error('--processes and --force need --batch')
+        jobdir, outputdir, jobindex = a.directories
+        jobdirs = [jobdir]
 
-    if not os.path.exists(jobdir):
-        raise Exception("Input directory {0} does not exist.".format(jobdir))
     if not os.path.exists(outputdir):
         raise Exception("Output directory {0} does not exist!".format(outputdir))
-
-    training_job(jobdir, outputdir, jobindex)
+    missing = [d for d in jobdirs if not os.path.exists(d)]
+    if len(missing) != 0:
+        raise Exception("Input directories {0} do not exist.".format(missing))
+
+    init_render_worker()
+    if a.batch:
+        status = batch_training_jobs(jobdirs, outputdir, a.processes, a.force, a.chunksize, a.profile, a.workers)
+        for jobindex in sorted(status):
+            print ("{0}: {1}".format(jobindex, status[jobindex]))
+    else:
+        dump_training_job(jobdir, outputdir, jobindex, a.workers, a.chunksize, a.profile)
 
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,226 @@
+#
+# Greedy forward and backward selection of the training variables.
+# Each round trains all the candidate variable lists in parallel (see get_training_performance),
+# and every result is remembered in an on-disk cache. Re-running or extending a scan only
+# trains the variable lists that have never been seen before for this data and training setup.
+#
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+import bdt_training_scikit_tools
+from bdt_training_scikit_tools import default_training_variable_list, full_precision_columns
+from get_training_performance import share_training_data, do_shared_training, headless_pool
+from instrumentation import profiled
+
+# The training setup used by the scans (passed on to get_shared_training_performance)
+default_selection_config = {'event_mod': 3, 'estimators': 400}
+
+# The columns every training depends on, whatever its variables
+fingerprint_columns = ['EventNumber'] + full_precision_columns
+
+def column_fingerprints(all_events, columns = None):
+    '''Return a hash of the contents of each column of a tripple of (bib, mj, sig) samples.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        columns - the columns to hash. None means every column of the samples.
+
+    Returns
+        hashes - dict of column name to its hash
+    '''
+    if columns is None:
+        columns = [c for c in all_events[0].columns if all(c in s.columns for s in all_events)]
+    hashes = {}
+    for c in columns:
+        h = hashlib.sha1()
+        for s in all_events:
+            a = np.ascontiguousarray(s[c].values)
+            h.update(json.dumps([str(c), str(a.dtype), len(a)]).encode('utf-8'))
+            h.update(a.tobytes())
+        hashes[c] = h.hexdigest()
+    return hashes
+
+def subset_fingerprint(hashes, variables):
+    '''Combine the column hashes (see column_fingerprints) of a set of training variables, the
+    event numbers and all the weights (training and evaluation) into one fingerprint. It only
+    depends on the data a training with those variables sees, so a different job, sub-sample,
+    re-dump or re-weighting gives a different fingerprint, but another scan on the same data doesn't.'''
+    columns = sorted(set(variables) | set(fingerprint_columns))
+    k = json.dumps([[c, hashes[c]] for c in columns])
+    return hashlib.sha1(k.encode('utf-8')).hexdigest()
+
+def data_fingerprint(all_events, variables = None):
+    '''Return a short hash that identifies a tripple of (bib, mj, sig) samples, as seen by a training
+    on variables (None means every column of the samples). See subset_fingerprint.'''
+    columns = None if variables is None else sorted(set(variables) | set(fingerprint_columns))
+    hashes = column_fingerprints(all_events, columns)
+    return subset_fingerprint(hashes, list(hashes) if variables is None else variables)
+
+def resolve_config(config):
+    '''The training setup of a scan, with the backend filled in (None means default_training_backend)'''
+    config = dict(default_selection_config, **(config if config is not None else {}))
+    if config.get('backend') is None:
+        config['backend'] = bdt_training_scikit_tools.default_training_backend
+    return config
+
+def selection_key(training_list, config, fingerprint):
+    '''Cache key for a training: the set of variables, the training setup (including the backend,
+    see resolve_config), and the data it sees (see subset_fingerprint)'''
+    k = json.dumps([sorted(training_list), sorted(config.items()), fingerprint])
+    return hashlib.sha1(k.encode('utf-8')).hexdigest()
+
+class SelectionCache:
+    '''Performance tables of trainings that have already been run, kept in a file.
+
+    The file has one json line per training, so it is only ever appended to and a scan
+    that is interrupted loses at most the training that was running.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if len(line.strip()) != 0:
+                        r = json.loads(line)
+                        self.results[r['key']] = r['result']
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+    def add(self, key, training_list, result):
+        '''Record a new result, and write it to disk right away'''
+        result = {k: float(v) for k, v in result.items()}
+        self.results[key] = result
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'key': key, 'variables': sorted(training_list), 'result': result}) + '\n')
+
+def evaluate_variable_lists(shared, training_lists, cache, hashes, config, pool):
+    '''Return the performance table for each variable list, training only those that are not in the cache.
+    Each list is keyed on the data of just its own columns (hashes is from column_fingerprints), so
+    a scan from a different start list still finds the lists an earlier scan trained.
+
+    Returns
+        results - list of performance dicts, in the same order as training_lists
+    '''
+    keys = [selection_key(tl, config, subset_fingerprint(hashes, tl)) for tl in training_lists]
+    todo = [(k, tl) for k, tl in zip(keys, training_lists) if k not in cache]
+
+    # The same list might show up twice in a round - only train it once.
+    todo = list({k: tl for k, tl in todo}.items())
+    if len(todo) != 0:
+        results = pool.map(do_shared_training, [(shared, tl, config) for k, tl in todo])
+        for (k, tl), r in zip(todo, results):
+            cache.add(k, tl, r[tuple(tl)])
+
+    return [cache[k] for k in keys]
+
+def profile_prefix_for(cache_path, profile):
+    '''Where a scan writes its profile report: next to its cache file (None if it isn't profiled)'''
+    if not profile:
+        return None
+    return os.path.splitext(cache_path if cache_path is not None else 'variable_selection')[0] + '-profile'
+
+def _run_selection(all_events, start_list, candidates_for, describe, cache_path, config, metric, min_improvement, max_rounds, pool, processes, profile = False):
+    '''Common driver for the forward and backward selection'''
+    profile_prefix = profile_prefix_for(cache_path, profile)
+    config = resolve_config(config)
+    cache = SelectionCache(cache_path)
+
+    # Every variable that could show up in a round
+    variables = list(start_list)
+    for tl in candidates_for(start_list):
+        variables = variables + [v for v in tl if v not in variables]
+    hashes = column_fingerprints(all_events, sorted(set(variables) | set(fingerprint_columns)))
+
+    with profiled(profile_prefix):
+        shared = share_training_data(all_events, variables)
+        own_pool = pool is None
+        history = []
+        try:
+            if own_pool:
+                pool = headless_pool(processes)
+
+            current = list(start_list)
+            current_score = None
+            if len(current) != 0:
+                current_score = evaluate_variable_lists(shared, [current], cache, hashes, config, pool)[0][metric]
+                history.append({'Round': 0, 'Change': None, 'Variables': tuple(current), metric: current_score})
+
+            r = 1
+            while max_rounds is None or r <= max_rounds:
+                candidates = candidates_for(current)
+                if len(candidates) == 0:
+                    break
+                results = evaluate_variable_lists(shared, candidates, cache, hashes, config, pool)
+                scores = [res[metric] for res in results]
+                best = int(np.argmax(scores))
+
+                # Stop as soon as the figure of merit doesn't get any better.
+                if current_score is not None and scores[best] <= current_score + min_improvement:
+                    break
+
+                history.append({'Round': r, 'Change': describe(current, candidates[best]), 'Variables': tuple(candidates[best]), metric: scores[best]})
+                current = candidates[best]
+                current_score = scores[best]
+                r += 1
+        finally:
+            if own_pool and pool is not None:
+                pool.close()
+                pool.join()
+            shared.cleanup()
+
+    return pd.DataFrame(history, columns=['Round', 'Change', 'Variables', metric])
+
+def backward_elimination(all_events, training_list = default_training_variable_list, cache_path = 'variable_selection_cache.json',
+                         config = None, metric = 'HSSSsqrtB', min_improvement = 0.0, max_rounds = None, pool = None, processes = 10, profile = False):
+    '''Remove one variable at a time, each round dropping the variable whose removal gives the best performance.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        training_list - the variables to start from
+        cache_path - file where results are remembered between runs
+        config - dict of training options for get_shared_training_performance (event_mod, estimators, backend)
+        metric - the figure of merit in the performance table to maximize
+        min_improvement - stop when the best list in a round doesn't beat the previous round by more than this
+        max_rounds - stop after this many rounds (None means keep going)
+        pool - multiprocessing pool to use. If None one is created with processes workers.
+        profile - if True, time each stage of the scan (loading, fits, predictions...) in this process
+                  and the workers, and write a report next to the cache (see instrumentation.report)
+
+    Returns
+        history - DataFrame with a row for the start and for each round: the variable dropped,
+                  the variables left, and the figure of merit.
+    '''
+    def candidates_for(current):
+        return [[v for v in current if v != drop] for drop in current] if len(current) > 1 else []
+    def describe(current, chosen):
+        return '-' + [v for v in current if v not in chosen][0]
+    return _run_selection(all_events, training_list, candidates_for, describe, cache_path, config, metric, min_improvement, max_rounds, pool, processes, profile)
+
+def forward_selection(all_events, training_list = default_training_variable_list, start_list = (), cache_path = 'variable_selection_cache.json',
+                      config = None, metric = 'HSSSsqrtB', min_improvement = 0.0, max_rounds = None, pool = None, processes = 10, profile = False):
+    '''Add one variable at a time, each round adding the variable that gives the best performance.
+
+    Args
+        all_events - tripple of (bib, mj, sig) events
+        training_list - the variables that can be added
+        start_list - the variables to start from
+        (the rest are as for backward_elimination)
+
+    Returns
+        history - DataFrame with a row for the start (if start_list isn't empty) and for each round:
+                  the variable added, the variables used, and the figure of merit.
+    '''
+    def candidates_for(current):
+        return [list(current) + [v] for v in training_list if v not in current]
+    def describe(current, chosen):
+        return '+' + chosen[-1]
+    return _run_selection(all_events, start_list, candidates_for, describe, cache_path, config, metric, min_improvement, max_rounds, pool, processes, profile)